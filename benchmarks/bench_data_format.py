@@ -0,0 +1,87 @@
+# ---------------------------------------------
+# BENCHMARK: format snapshotu (DATA_FORMAT)
+# Czas zapisu (serializacja + fsync), czas wczytania (load_data) i rozmiar
+# pliku dla "json" (dotychczasowy data.json), "compact" i "msgpack".
+# Uruchomienie z katalogu repozytorium:
+#   python benchmarks/bench_data_format.py [liczba_użytkowników]
+# ---------------------------------------------
+import os
+import sys
+import time
+import random
+import logging
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import bot  # noqa: E402
+
+GUILD_ID = 1
+MONTHS = ("2026-08", "2026-09", "2026-10")
+
+def populate(count: int, now: float, seed: int = 1234):
+    rng = random.Random(seed)
+    state = bot.get_guild_state(GUILD_ID)
+    for user_id in range(count):
+        status = bot.UserStatus(f"user{user_id}")
+        for idx in range(len(bot.SUBSTANCES)):
+            if rng.random() < 0.3:
+                status.counts[idx] = rng.randint(1, 5)
+                status.expires[idx] = now + rng.randint(600, 24 * 3600)
+        for month in MONTHS[rng.randint(0, len(MONTHS) - 1):]:
+            month_array = status.month_stats(month)
+            for idx in range(len(bot.SUBSTANCES)):
+                month_array[idx] = rng.randint(0, 40)
+        state.users[user_id] = status
+
+def snapshot_digest() -> dict:
+    # Stan po wczytaniu do porównania między formatami (terminy z dokładnością do sekundy)
+    state = bot.guild_states[GUILD_ID]
+    return {
+        user_id: (status.original_nick, tuple(status.counts), tuple(int(ts + 0.999) for ts in status.expires),
+                  {month: tuple(stats) for month, stats in status.monthly_usage.items()})
+        for user_id, status in state.users.items()
+    }
+
+def run_format(fmt: str, count: int, now: float) -> tuple:
+    workdir = tempfile.mkdtemp(prefix=f"alkobot-format-{fmt}-")
+    os.chdir(workdir)
+    bot.DATA_FORMAT = fmt
+    bot.guild_states.clear()
+    populate(count, now)
+    storage = bot.storage = bot.JsonStorage(bot.DATA_FILE, bot.JOURNAL_FILE)
+
+    start = time.perf_counter()
+    storage.compact_job(bot.capture_snapshot())()
+    saved = time.perf_counter() - start
+    size = os.path.getsize(bot.DATA_FILE)
+
+    bot.guild_states.clear()
+    start = time.perf_counter()
+    bot.load_data()
+    loaded = time.perf_counter() - start
+    storage.close()
+    return saved, loaded, size, snapshot_digest()
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    logging.getLogger().setLevel(logging.WARNING)
+    formats = ["json", "compact"]
+    if bot.msgpack is not None:
+        formats.append("msgpack")
+    now = time.time()  # Wspólne terminy dla wszystkich formatów
+    rows = []
+    reference = None
+    for fmt in formats:
+        saved, loaded, size, digest = run_format(fmt, count, now)
+        if reference is None:
+            reference = digest
+        rows.append((fmt, saved, loaded, size, digest == reference))
+    print(f"Użytkowników: {count}" + ("" if bot.msgpack is not None else " (brak pakietu msgpack – pominięty)"))
+    print(f"{'format':<9} {'zapis [s]':>9} {'wczytanie [s]':>13} {'rozmiar [MiB]':>13} {'vs json':>8}  zgodny")
+    base = rows[0][3]
+    for fmt, saved, loaded, size, same in rows:
+        print(f"{fmt:<9} {saved:>9.3f} {loaded:>13.3f} {size / 1024 / 1024:>13.1f} {size / base:>8.0%}  {'tak' if same else 'NIE'}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+# ---------------------------------------------
+# BENCHMARK: ścieżki bota na syntetycznych populacjach
+# load_data / add_usage + save_data / compact_data, clean_statuses,
+# leaderboardy i kolejka nicków – bez Discorda (atrapy z fake_discord.py).
+# Uruchomienie z katalogu repozytorium:
+#   python benchmarks/bench_harness.py [--sizes 1000,10000,100000] [--backend json|sqlite]
+# ---------------------------------------------
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+sys.path.insert(0, HERE)
+
+import bot  # noqa: E402
+from fake_discord import FakeHTTP, FakeGuild, install  # noqa: E402
+
+GUILD_ID = 1
+
+def percentile(samples: list, q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+class Report:
+    def __init__(self):
+        self.rows = []
+
+    def add(self, size: int, name: str, count: int, elapsed: float, samples: list = None, extra: str = ""):
+        self.rows.append((size, name, count, elapsed, samples or [], extra))
+
+    def print(self):
+        print(f"{'n':>7}  {'operacja':<24} {'liczba':>7} {'czas [s]':>9} {'op/s':>10} {'p50 [ms]':>9} {'p95 [ms]':>9}  uwagi")
+        for size, name, count, elapsed, samples, extra in self.rows:
+            rate = count / elapsed if elapsed else float("inf")
+            p50 = percentile(samples, 0.50) * 1000
+            p95 = percentile(samples, 0.95) * 1000
+            print(f"{size:>7}  {name:<24} {count:>7} {elapsed:>9.3f} {rate:>10.0f} {p50:>9.3f} {p95:>9.3f}  {extra}")
+
+def write_snapshot(guild: FakeGuild, rng: random.Random):
+    # Gotowy data.json zamiast wielu add_usage – start ma mierzyć samo wczytanie
+    month = bot.get_current_month()
+    now = time.time()
+    users = {}
+    for member in guild.members:
+        status = bot.UserStatus(member.name)
+        for idx in range(len(bot.SUBSTANCES)):
+            if rng.random() < 0.3:
+                status.counts[idx] = rng.randint(1, 4)
+                status.expires[idx] = now + rng.randint(600, 4 * 3600)
+            status.month_stats(month)[idx] = rng.randint(0, 30)
+        users[str(member.id)] = status.to_json()
+    snapshot = {"settings": {}, "guilds": {str(guild.id): {"settings": {}, "users": users}}}
+    with open(bot.DATA_FILE, "w", encoding="utf-8") as f:
+        json.dump(snapshot, f)
+
+async def run_size(size: int, args, report: Report):
+    workdir = tempfile.mkdtemp(prefix=f"alkobot-bench-{size}-")
+    os.chdir(workdir)
+    rng = random.Random(size)
+    http = FakeHTTP(limit=args.rate_limit, per=args.rate_window, latency=args.latency)
+    guild = FakeGuild(GUILD_ID, size, http)
+    install(bot, [guild])
+    write_snapshot(guild, rng)
+    if args.backend == "sqlite":
+        bot.STORAGE_BACKEND = "sqlite"
+    bot.storage = bot.create_storage()
+
+    # 1. Wczytanie danych (przy sqlite – z migracją z data.json przy pierwszym starcie)
+    start = time.perf_counter()
+    bot.load_data()
+    report.add(size, "load_data", size, time.perf_counter() - start, extra=f"backend {args.backend}")
+
+    # 2. Mutacje + zapis
+    count = min(size, args.mutations)
+    samples = []
+    start = time.perf_counter()
+    for i in range(count):
+        member = guild.members[rng.randrange(size)]
+        t = time.perf_counter()
+        bot.add_usage(GUILD_ID, member.id, member.name, rng.choice(bot.SUBSTANCES), 1)
+        samples.append(time.perf_counter() - t)
+    report.add(size, "add_usage", count, time.perf_counter() - start, samples)
+    # Zapis idzie w tle: osobno czas zgłoszenia (blokuje pętlę) i czas do utrwalenia
+    start = time.perf_counter()
+    bot.save_data()
+    report.add(size, "save_data (zgłoszenie)", 1, time.perf_counter() - start)
+    await bot.persistence.flush()
+    report.add(size, "save_data (utrwalone)", 1, time.perf_counter() - start)
+    start = time.perf_counter()
+    bot.compact_data()
+    await bot.persistence.flush()
+    report.add(size, "compact_data", 1, time.perf_counter() - start,
+               extra=f"na pętli maks. {bot.metrics.histograms[('persist_prepare_seconds', ())].max:.3f}s")
+
+    # 3. Leaderboardy
+    state = bot.get_guild_state(GUILD_ID)
+    start = time.perf_counter()
+    bot.build_leaderboard_text(guild)
+    report.add(size, "build_leaderboard_text", 1, time.perf_counter() - start)
+    start = time.perf_counter()
+    embed = bot.build_leaderboard_embed(guild)
+    report.add(size, "build_leaderboard_embed", 1, time.perf_counter() - start, extra=f"{len(embed.fields)} pól")
+
+    # 4. clean_statuses: 10% użytkowników z wygasającym statusem
+    now = time.time()
+    due = 0
+    for member in guild.members[: max(size // 10, 1)]:
+        status = state.users.get(member.id)
+        if status is None:
+            continue
+        for idx, count_left in enumerate(status.counts):
+            if count_left:
+                status.expires[idx] = now - 1
+                due += 1
+    bot.rebuild_expiry_heap()
+    bot.nickname_queue = bot.NicknameQueue()  # bez workerów – mierzymy samo zlecanie
+    start = time.perf_counter()
+    await bot.clean_statuses.coro()
+    queued = bot.nickname_queue.stats()
+    report.add(size, "clean_statuses", due, time.perf_counter() - start,
+               extra=f"zleceń nicków {queued['submitted']}, pominiętych {queued['skipped']}")
+
+    # 5. Kolejka nicków przez FakeHTTP z rate limitem
+    edits = min(size, args.nick_edits)
+    bot.NICK_EDIT_INTERVAL = args.nick_interval
+    bot.nickname_queue = bot.NicknameQueue()
+    bot.nickname_queue.start()
+    http.calls = http.rate_limited = 0
+    samples = []
+    start = time.perf_counter()
+    for member in guild.members[:edits]:
+        bot.add_usage(GUILD_ID, member.id, member.name, "piwo", 1)
+        t = time.perf_counter()
+        await bot.update_nickname(member)
+        samples.append(time.perf_counter() - t)
+    await bot.nickname_queue.join()
+    elapsed = time.perf_counter() - start
+    stats = bot.nickname_queue.stats()
+    bot.nickname_queue.stop()
+    report.add(size, "update_nickname (edycje)", stats["edited"], elapsed, samples,
+               extra=f"429: {http.rate_limited} (ponowione {stats['retried']}, utracone {edits - stats['edited']}), opóźnienie śr. {stats['latency_avg']:.2f}s / maks. {stats['latency_max']:.2f}s")
+
+    if bot.leaderboard_refresh_task:
+        bot.leaderboard_refresh_task.cancel()
+    bot.storage.close()
+    bot.usage_archive.close()
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark bota na atrapach Discorda")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="Liczby użytkowników, po przecinku")
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--mutations", type=int, default=5000, help="Ile add_usage na rozmiar")
+    parser.add_argument("--nick-edits", type=int, default=200, help="Ile edycji nicków przez kolejkę")
+    parser.add_argument("--nick-interval", type=float, default=0.01, help="NICK_EDIT_INTERVAL w benchmarku")
+    parser.add_argument("--rate-limit", type=int, default=50, help="Żądań na okno w jednym buckecie")
+    parser.add_argument("--rate-window", type=float, default=1.0, help="Długość okna rate limitu (s)")
+    parser.add_argument("--latency", type=float, default=0.002, help="Symulowane opóźnienie żądania (s)")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    report = Report()
+    for size in (int(s) for s in args.sizes.split(",")):
+        await run_size(size, args, report)
+    report.print()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,86 @@
+# ---------------------------------------------
+# BENCHMARK: pamięć statusów użytkowników
+# Porównuje dawny układ (słownik na użytkownika, datetime w terminach)
+# z UserStatus (__slots__ + tablice). Uruchomienie z katalogu repozytorium:
+#   python benchmarks/bench_userstatus_memory.py [liczba_użytkowników]
+# ---------------------------------------------
+import os
+import sys
+import gc
+import time
+import random
+import datetime
+import tracemalloc
+from datetime import timezone, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bot import SUBSTANCES, UserStatus  # noqa: E402
+
+MONTHS = ("2026-08", "2026-09", "2026-10")
+
+def synthetic_users(count: int, seed: int = 1234):
+    rng = random.Random(seed)
+    now = datetime.datetime.now(timezone.utc)
+    for user_id in range(count):
+        counts = [rng.randint(0, 5) for _ in SUBSTANCES]
+        expires = [now + timedelta(hours=rng.randint(1, 24)) if c else None for c in counts]
+        monthly = {
+            month: {typ: rng.randint(0, 40) for typ in SUBSTANCES}
+            for month in MONTHS[rng.randint(0, len(MONTHS) - 1):]
+        }
+        yield user_id, f"user{user_id}", counts, expires, monthly
+
+def build_dict_layout(users):
+    result = {}
+    for user_id, nick, counts, expires, monthly in users:
+        data = {"original_nick": nick}
+        for typ, count in zip(SUBSTANCES, counts):
+            data[typ] = count
+        data["monthly_usage"] = {month: dict(stats) for month, stats in monthly.items()}
+        data["expires_per_substance"] = dict(zip(SUBSTANCES, expires))
+        result[user_id] = data
+    return result
+
+def build_userstatus_layout(users):
+    result = {}
+    for user_id, nick, counts, expires, monthly in users:
+        status = UserStatus(nick)
+        for i, (count, exp) in enumerate(zip(counts, expires)):
+            status.counts[i] = count
+            status.expires[i] = exp.timestamp() if exp else 0.0
+        for month, stats in monthly.items():
+            month_array = status.month_stats(month)
+            for i, typ in enumerate(SUBSTANCES):
+                month_array[i] = stats[typ]
+        result[user_id] = status
+    return result
+
+def measure(builder, count: int):
+    # Dane wejściowe generujemy przed pomiarem, żeby liczyć tylko strukturę docelową
+    users = list(synthetic_users(count))
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = builder(users)
+    elapsed = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del users
+    return result, current, elapsed
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    rows = []
+    for name, builder in (("dict", build_dict_layout), ("UserStatus", build_userstatus_layout)):
+        result, used, elapsed = measure(builder, count)
+        rows.append((name, used, elapsed))
+        del result
+        gc.collect()
+    print(f"Użytkowników: {count}")
+    for name, used, elapsed in rows:
+        print(f"{name:<12} {used / 1024 / 1024:8.1f} MiB  {used / count:7.0f} B/użytk.  budowa {elapsed:.2f}s")
+    print(f"Oszczędność: {1 - rows[1][1] / rows[0][1]:.0%}")
+
+if __name__ == "__main__":
+    main()
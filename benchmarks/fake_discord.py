@@ -0,0 +1,148 @@
+# ---------------------------------------------
+# ATRAPY DISCORDA dla benchmarków
+# Gildie, członkowie, kanały i wiadomości bez połączenia z Discordem.
+# Każde wywołanie "API" przechodzi przez FakeHTTP, które dolicza opóźnienie
+# sieci i symuluje rate limit (429 z retry_after) per bucket.
+# ---------------------------------------------
+import time
+import asyncio
+import random
+from types import SimpleNamespace
+
+import discord
+
+class FakeResponse:
+    def __init__(self, status: int, reason: str):
+        self.status = status
+        self.reason = reason
+
+class FakeRateLimited(discord.HTTPException):
+    def __init__(self, retry_after: float):
+        super().__init__(FakeResponse(429, "Too Many Requests"), "You are being rate limited.")
+        self.retry_after = retry_after
+
+class FakeHTTP:
+    """
+    Okno stałej długości per bucket: `limit` żądań na `per` sekund,
+    każde żądanie trwa `latency` (± jitter). Po przekroczeniu – FakeRateLimited.
+    """
+
+    def __init__(self, limit: int = 10, per: float = 10.0, latency: float = 0.0, jitter: float = 0.0):
+        self.limit = limit
+        self.per = per
+        self.latency = latency
+        self.jitter = jitter
+        self.windows = {}  # {bucket: (początek okna, liczba żądań)}
+        self.calls = 0
+        self.rate_limited = 0
+        self.rng = random.Random(42)
+
+    async def request(self, bucket):
+        self.calls += 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + self.rng.uniform(0, self.jitter))
+        now = time.monotonic()
+        start, count = self.windows.get(bucket, (now, 0))
+        if now - start >= self.per:
+            start, count = now, 0
+        if count >= self.limit:
+            self.rate_limited += 1
+            raise FakeRateLimited(start + self.per - now)
+        self.windows[bucket] = (start, count + 1)
+
+class FakeMessage:
+    def __init__(self, channel, message_id: int, content=None, embed=None):
+        self.channel = channel
+        self.id = message_id
+        self.content = content
+        self.embed = embed
+
+    async def edit(self, content=None, embed=None):
+        await self.channel.guild.http.request(("message", self.channel.id))
+        self.content = content if content is not None else self.content
+        self.embed = embed if embed is not None else self.embed
+        return self
+
+    async def add_reaction(self, emoji):
+        await self.channel.guild.http.request(("reaction", self.channel.id))
+
+    async def remove_reaction(self, emoji, member):
+        await self.channel.guild.http.request(("reaction", self.channel.id))
+
+class FakeChannel:
+    def __init__(self, guild, channel_id: int):
+        self.guild = guild
+        self.id = channel_id
+        self.messages = {}
+        self.next_id = channel_id * 1000
+
+    async def send(self, content=None, embed=None):
+        await self.guild.http.request(("message", self.id))
+        self.next_id += 1
+        message = FakeMessage(self, self.next_id, content, embed)
+        self.messages[message.id] = message
+        return message
+
+    async def fetch_message(self, message_id):
+        await self.guild.http.request(("fetch", self.id))
+        if message_id not in self.messages:
+            raise discord.NotFound(FakeResponse(404, "Not Found"), "Unknown Message")
+        return self.messages[message_id]
+
+    def get_partial_message(self, message_id):
+        return self.messages.get(message_id) or FakeMessage(self, message_id)
+
+class FakeMember:
+    def __init__(self, guild, member_id: int, name: str, nick: str = None):
+        self.guild = guild
+        self.id = member_id
+        self.name = name
+        self.nick = nick
+        self.bot = False
+        self.guild_permissions = SimpleNamespace(administrator=False, manage_nicknames=False)
+
+    @property
+    def display_name(self):
+        return self.nick or self.name
+
+    @property
+    def mention(self):
+        return f"<@{self.id}>"
+
+    async def edit(self, nick=None):
+        # Edycje członków jednej gildii dzielą bucket – jak PATCH /guilds/{id}/members/{id}
+        await self.guild.http.request(("member", self.guild.id))
+        self.nick = nick
+
+    async def send(self, content=None, embed=None):
+        await self.guild.http.request(("dm", self.id))
+
+class FakeGuild:
+    def __init__(self, guild_id: int, member_count: int, http: FakeHTTP, name: str = None):
+        self.id = guild_id
+        self.name = name or f"guild-{guild_id}"
+        self.http = http
+        self.owner_id = 0
+        self.members = [
+            FakeMember(self, guild_id * 10_000_000 + i, f"user{i}")
+            for i in range(member_count)
+        ]
+        self.member_map = {m.id: m for m in self.members}
+        self.channels = {}
+
+    def get_member(self, member_id):
+        return self.member_map.get(member_id)
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    def add_channel(self, channel_id: int) -> FakeChannel:
+        channel = FakeChannel(self, channel_id)
+        self.channels[channel_id] = channel
+        return channel
+
+def install(bot_module, guilds: list):
+    # Podpina atrapy pod instancję commands.Bot z bot.py (get_guild, guilds)
+    by_id = {g.id: g for g in guilds}
+    bot_module.bot.get_guild = by_id.get
+    type(bot_module.bot).guilds = property(lambda self: list(by_id.values()))
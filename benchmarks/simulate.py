@@ -0,0 +1,287 @@
+# ---------------------------------------------
+# SYMULATOR: odtwarzanie zdarzeń w przyspieszonym czasie
+# Zdarzenia z dziennika (EVENT_LOG_FILE w bot.py) albo syntetyczne przechodzą
+# przez prawdziwe mutacje bota z podmienionym zegarem (bot.clock): wygaśnięcia
+# z kopca, przełom miesiąca (export_monthly_stats) i rankingi. Na końcu stan
+# porównujemy z modelem referencyjnym, z archiwum miesięcy i ze stanem
+# wczytanym ponownie z dysku. Symulacja startuje od pustego stanu – dziennik
+# do porównań nagrywaj od świeżego data.json.
+# Uruchomienie z katalogu repozytorium:
+#   python benchmarks/simulate.py [--log events.jsonl] [--users 2000 --days 62 --events-per-day 5000]
+# ---------------------------------------------
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import datetime
+import tempfile
+from datetime import timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import bot  # noqa: E402
+
+class SimulatedClock(bot.Clock):
+    def __init__(self, start: float):
+        self.current = start
+
+    def time(self) -> float:
+        return self.current
+
+    def now(self) -> datetime.datetime:
+        return datetime.datetime.fromtimestamp(self.current, timezone.utc)
+
+def month_of(ts: float) -> str:
+    return datetime.datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m")
+
+def synthetic_events(args) -> list:
+    # Ruch z przerwami nocnymi nie ma znaczenia dla stanu – rozkład jednostajny wystarczy
+    rng = random.Random(args.seed)
+    start = datetime.datetime.fromisoformat(args.start).replace(tzinfo=timezone.utc).timestamp()
+    span = args.days * 86400
+    events = []
+    for _ in range(args.days * args.events_per_day):
+        at = start + rng.random() * span
+        guild_id = rng.randint(1, args.guilds)
+        user_id = rng.randrange(args.users)
+        roll = rng.random()
+        if roll < 0.90:
+            events.append({"at": at, "op": "usage", "guild": guild_id, "user": user_id, "nick": f"user{user_id}",
+                           "typ": rng.choice(bot.SUBSTANCES), "amount": rng.randint(1, 3)})
+        elif roll < 0.98:
+            events.append({"at": at, "op": "clear", "guild": guild_id, "user": user_id})
+        elif roll < 0.99:
+            events.append({"at": at, "op": "nick", "guild": guild_id, "user": user_id, "value": f"nick{rng.randrange(100)}"})
+        else:
+            events.append({"at": at, "op": "settings", "guild": guild_id, "key": "listening_channel_id",
+                           "value": rng.choice((None, rng.randrange(1, 10**6)))})
+    events.sort(key=lambda event: event["at"])
+    return events
+
+def read_events(path: str) -> list:
+    with open(path, "r", encoding="utf-8") as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    events.sort(key=lambda event: event["at"])
+    return events
+
+class Reference:
+    """Model stanu liczony wprost ze zdarzeń, bez kopca, indeksów i dziennika."""
+
+    def __init__(self):
+        self.users = {}     # {(guild_id, user_id): [nick, liczniki, terminy, {miesiąc: liczniki}]}
+        self.settings = {}  # {guild_id: {klucz: wartość}}
+        self.archived = {}  # {(guild_id, user_id): liczniki z wyeksportowanych miesięcy}
+
+    def guild_settings(self, guild_id: int) -> dict:
+        return self.settings.setdefault(guild_id, {key: None for key in bot.SETTINGS_KEYS})
+
+    def apply(self, event: dict):
+        op, at = event["op"], event["at"]
+        guild_id = event["guild"]
+        if op == "settings":
+            self.guild_settings(guild_id)[event["key"]] = event["value"]
+            return
+        key = (guild_id, event["user"])
+        user = self.users.get(key)
+        if op == "usage":
+            self.guild_settings(guild_id)
+            if user is None:
+                user = self.users[key] = [event.get("nick", ""), [0] * len(bot.SUBSTANCES), [0.0] * len(bot.SUBSTANCES), {}]
+            idx = bot.SUBSTANCE_INDEX[event["typ"]]
+            self.expire(user, idx, at)
+            user[1][idx] += event["amount"]
+            user[2][idx] = (datetime.datetime.fromtimestamp(at, timezone.utc)
+                            + datetime.timedelta(hours=bot.TIME_TO_EXPIRE[event["typ"]])).timestamp()
+            user[3].setdefault(month_of(at), [0] * len(bot.SUBSTANCES))[idx] += event["amount"]
+        elif user is None:
+            return
+        elif op == "clear":
+            user[1] = [0] * len(bot.SUBSTANCES)
+            user[2] = [0.0] * len(bot.SUBSTANCES)
+        elif op == "nick":
+            user[0] = event["value"]
+
+    @staticmethod
+    def expire(user: list, idx: int, at: float):
+        if user[1][idx] > 0 and user[2][idx] <= at:
+            user[1][idx] = 0
+            user[2][idx] = 0.0
+
+    def finish(self, at: float, current_month: str):
+        # Koniec symulacji: wygaśnięcia do `at` i zdjęcie wyeksportowanych miesięcy
+        for (guild_id, user_id), user in self.users.items():
+            for idx in range(len(bot.SUBSTANCES)):
+                self.expire(user, idx, at)
+            for month in [month for month in user[3] if month < current_month]:
+                stats = user[3].pop(month)
+                archived = self.archived.setdefault((guild_id, user_id), [0] * len(bot.SUBSTANCES))
+                for idx, count in enumerate(stats):
+                    archived[idx] += count
+                settings = self.guild_settings(guild_id)
+                settings["last_exported_month"] = max(settings["last_exported_month"] or "", month)
+
+    def digest(self) -> dict:
+        users = {
+            key: (user[0], tuple(user[1]), tuple(round(ts, 3) for ts in user[2]),
+                  {month: tuple(stats) for month, stats in user[3].items()})
+            for key, user in self.users.items()
+        }
+        return {"users": users, "settings": self.settings}
+
+def state_digest() -> dict:
+    users = {}
+    settings = {}
+    for guild_id, state in bot.guild_states.items():
+        settings[guild_id] = dict(state.settings)
+        for user_id, status in state.users.items():
+            users[(guild_id, user_id)] = (
+                status.original_nick, tuple(status.counts), tuple(round(ts, 3) for ts in status.expires),
+                {month: tuple(stats) for month, stats in status.monthly_usage.items()}
+            )
+    return {"users": users, "settings": settings}
+
+def describe_difference(expected: dict, actual: dict) -> str:
+    if expected == actual:
+        return "zgodny"
+    for part in ("settings", "users"):
+        keys = set(expected[part]) | set(actual[part])
+        for key in sorted(keys, key=str):
+            if expected[part].get(key) != actual[part].get(key):
+                return f"NIEZGODNY ({part} {key}: oczekiwano {expected[part].get(key)}, jest {actual[part].get(key)})"
+    return "NIEZGODNY"
+
+def check_rankings(reference: Reference) -> str:
+    # Kolejność LeaderboardIndex musi odpowiadać sortowaniu sum miesięcznych wprost
+    for guild_id, state in bot.guild_states.items():
+        months = {month for (gid, _), user in reference.users.items() if gid == guild_id for month in user[3]}
+        for month in months:
+            expected = sorted(
+                (-sum(user[3][month]), user_id) for (gid, user_id), user in reference.users.items()
+                if gid == guild_id and sum(user[3].get(month, ())) > 0
+            )
+            actual = [(-total, user_id) for user_id, total in state.leaderboards.get(month, ())]
+            if expected != actual:
+                return f"NIEZGODNY (gildia {guild_id}, {month})"
+    return "zgodny"
+
+def check_archive(reference: Reference) -> str:
+    for (guild_id, user_id), expected in reference.archived.items():
+        actual = list(bot.usage_archive.user_totals(guild_id, user_id))
+        if actual != expected:
+            return f"NIEZGODNY (gildia {guild_id}, użytkownik {user_id}: oczekiwano {expected}, jest {actual})"
+    return "zgodny"
+
+class Costs:
+    def __init__(self):
+        self.samples = {}
+
+    def add(self, name: str, elapsed: float):
+        self.samples.setdefault(name, []).append(elapsed)
+
+    def print(self):
+        print(f"{'zdarzenie':<12} {'liczba':>8} {'razem [s]':>10} {'śr. [µs]':>10} {'p95 [µs]':>10} {'maks. [µs]':>11}")
+        for name, samples in sorted(self.samples.items()):
+            ordered = sorted(samples)
+            p95 = ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)]
+            total = sum(ordered)
+            print(f"{name:<12} {len(ordered):>8} {total:>10.3f} {total / len(ordered) * 1e6:>10.1f} "
+                  f"{p95 * 1e6:>10.1f} {ordered[-1] * 1e6:>11.1f}")
+
+def apply_event(event: dict):
+    op = event["op"]
+    if op == "usage":
+        bot.add_usage(event["guild"], event["user"], event.get("nick", ""), event["typ"], event["amount"])
+    elif op == "clear":
+        if event["user"] in bot.get_guild_state(event["guild"]).users:
+            bot.clear_usage(event["guild"], event["user"])
+    elif op == "nick":
+        bot.set_original_nick(event["guild"], event["user"], event["value"])
+    elif op == "settings":
+        bot.set_setting(event["guild"], event["key"], event["value"])
+    bot.save_data()
+
+async def simulate(events: list, costs: Costs) -> float:
+    clock = bot.clock = SimulatedClock(events[0]["at"])
+    current_month = month_of(clock.current)
+    for i, event in enumerate(events):
+        clock.current = event["at"]
+        if month_of(clock.current) != current_month:
+            current_month = month_of(clock.current)
+            start = time.perf_counter()
+            await bot.export_monthly_stats.coro()
+            costs.add("export", time.perf_counter() - start)
+        if bot.expiry_heap and bot.expiry_heap[0][0] <= clock.current:
+            start = time.perf_counter()
+            await bot.process_due_expiries()
+            costs.add("expire", time.perf_counter() - start)
+        start = time.perf_counter()
+        apply_event(event)
+        costs.add(event["op"], time.perf_counter() - start)
+        if i % 1000 == 0:
+            await asyncio.sleep(0)  # Zapis w tle (PersistenceService) też musi dostać pętlę
+    await bot.process_due_expiries()
+    return clock.current
+
+async def main():
+    parser = argparse.ArgumentParser(description="Odtwarzanie zdarzeń bota w przyspieszonym czasie")
+    parser.add_argument("--log", help="Dziennik zdarzeń (EVENT_LOG_FILE); bez niego – zdarzenia syntetyczne")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--guilds", type=int, default=2)
+    parser.add_argument("--days", type=int, default=62)
+    parser.add_argument("--events-per-day", type=int, default=5000)
+    parser.add_argument("--start", default="2026-01-20", help="Początek ruchu syntetycznego (UTC)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    events = read_events(args.log) if args.log else synthetic_events(args)
+    if not events:
+        print("Brak zdarzeń.")
+        return
+    os.chdir(tempfile.mkdtemp(prefix="alkobot-sim-"))
+    bot.event_log = None
+    bot.storage = bot.create_storage()
+    bot.usage_archive = bot.UsageArchive(bot.ARCHIVE_FOLDER)
+    bot.load_data()
+
+    costs = Costs()
+    wall = time.perf_counter()
+    end = await simulate(events, costs)
+    wall = time.perf_counter() - wall
+    await bot.persistence.flush()
+    if bot.leaderboard_refresh_task:
+        bot.leaderboard_refresh_task.cancel()
+
+    reference = Reference()
+    for event in events:
+        reference.apply(event)
+    reference.finish(end, month_of(end))
+    expected = reference.digest()
+    in_memory = state_digest()
+    rankings = check_rankings(reference)
+    archive = check_archive(reference)
+
+    bot.storage.close()
+    bot.guild_states.clear()
+    bot.storage = bot.create_storage()
+    bot.load_data()
+    await bot.persistence.flush()
+    reloaded = state_digest()
+    bot.storage.close()
+    bot.usage_archive.close()
+
+    simulated = end - events[0]["at"]
+    print(f"Zdarzeń: {len(events)}, symulowany czas {simulated / 86400:.1f} dni w {wall:.2f}s "
+          f"(przyspieszenie ×{simulated / wall:,.0f})")
+    print(f"Stan vs model referencyjny: {describe_difference(expected, in_memory)}")
+    print(f"Rankingi vs model referencyjny: {rankings}")
+    print(f"Archiwum miesięcy vs model referencyjny: {archive}")
+    print(f"Stan po ponownym wczytaniu z dysku: {describe_difference(in_memory, reloaded)}")
+    costs.print()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -2,12 +2,39 @@ import os
 from dotenv import load_dotenv
 import json
 import math
+import sqlite3
+import time
+import heapq
+import hashlib
+import socket
+import functools
+import contextlib
+import csv
+import io
+import mmap
+import struct
+import asyncio
 import logging
 import datetime
 from datetime import timezone, timedelta
+import bisect
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import discord
 from discord.ext import commands, tasks
 from discord import app_commands
+from aiohttp import web
+
+try:
+    from sortedcontainers import SortedList
+except ImportError:  # opcjonalna zależność – fallback na bisect
+    SortedList = None
+
+try:
+    import msgpack
+except ImportError:  # opcjonalna zależność – fallback na zwarty JSON
+    msgpack = None
 
 # ---------------------------------------------
 # KONFIGURACJA, STAŁE
@@ -19,17 +46,72 @@ logging.basicConfig(
 
 BOT_PREFIX = "."
 DATA_FILE = "data.json"
+DATA_FORMAT = "json"  # Format snapshotu: "json" (czytelny), "compact" (zwarty JSON) albo "msgpack" (binarny, gdy jest pakiet msgpack)
 NBSP = "\u00A0"  # non-breakable space separator
 STATS_FOLDER = "stats"  # Folder do eksportu statystyk
+ARCHIVE_FOLDER = "archive"  # Archiwum spożycia (zdarzenia bieżącego miesiąca + zamknięte miesiące)
+JOURNAL_FILE = "data.journal"  # Dziennik mutacji (append-only) od ostatniego snapshotu
+EVENT_LOG_FILE = None  # Dziennik zdarzeń wejściowych (JSON lines) do odtwarzania w benchmarks/simulate.py; None = wyłączony
+JOURNAL_COMPACT_THRESHOLD = 500  # Po tylu wpisach w dzienniku robimy snapshot
+STORAGE_BACKEND = "json"  # "json" (data.json + dziennik) albo "sqlite"
+SQLITE_FILE = "data.db"  # Baza dla backendu SQLite
+LEADERBOARD_DEBOUNCE_SECONDS = 5  # Seria zmian w tym oknie daje jedną edycję live leaderboardu
+PERSIST_COALESCE_WINDOW = 0.5  # Zgłoszenia zapisu w tym oknie (s) dają jeden zapis
+NICK_EDIT_INTERVAL = 1.0  # Minimalny odstęp (s) między edycjami nicków w jednej gildii (bucket PATCH /guilds/{id}/members)
+NICK_RENDER_CACHE_SIZE = 4096  # Zapamiętane wyniki render_nick (nick, liczniki)
+NICK_QUEUE_WORKERS = 4  # Liczba równoległych workerów kolejki nicków (różne gildie)
+REACTION_BATCH_WINDOW = 0.5  # Czas (s) zbierania reakcji w jedną paczkę
+REACTION_BATCH_SIZE = 500  # Maksymalna liczba reakcji w jednej paczce
+CLEAR_EMOJI = "❌"
+USER_RATE_BURST = 5  # Tyle zmian spożycia naraz może zrobić jeden użytkownik (token bucket)...
+USER_RATE_PER_SECOND = 0.2  # ...potem jedną na 5 s
+GUILD_RATE_BURST = 60  # Zmiany spożycia naraz w całej gildii...
+GUILD_RATE_PER_SECOND = 2.0  # ...potem dwie na sekundę
+LEADERBOARD_PAGE_SIZE = 10  # Pozycji na stronę rankingu (embed: maks. 25 pól)
+EMBED_PAGE_CHAR_BUDGET = 5000  # Znaków pól na stronę embeda (limit Discorda: 6000 na cały embed)
+TEXT_PAGE_CHAR_BUDGET = 1800  # Znaków linii na stronę tekstową (limit wiadomości: 2000)
+LEADERBOARD_VIEW_TIMEOUT = 300  # Po tylu sekundach bez kliknięcia przyciski stron wygasają
+METRICS_HOST = "127.0.0.1"  # Adres serwera /metrics (tylko lokalnie)
+METRICS_PORT = 9108  # Port /metrics w formacie Prometheusa; 0 = wyłączone
+LOOP_LAG_INTERVAL = 1.0  # Co ile sekund mierzymy opóźnienie pętli zdarzeń
+STARTUP_RECONCILE_CONCURRENCY = 4  # Ile gildii naraz porządkujemy po starcie (wiadomości, nicki)
+SHUTDOWN_DEADLINE = 30  # Ile sekund shutdown czeka na przywrócenie nicków; resztę odkłada na następny start
+LEASE_TTL = 90  # Dzierżawa zadania (s) – odnawiana przy każdym przebiegu, po awarii przejmuje ją inny proces
+EXPORT_LEASE_TTL = 900  # Dzierżawa eksportu miesiąca jednej gildii (s)
+MIGRATION_LEASE_TTL = 600  # Dzierżawa migracji data.json do bazy (s)
+
+# Sharding: kilka procesów bota, każdy z częścią shardów, wspólny stan w SQLITE_FILE.
+# Czytane już przy imporcie (konstrukcja bota), dlatego .env ładujemy tutaj.
+load_dotenv()
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))  # Liczba wszystkich shardów; 1 = bez shardingu
+SHARD_IDS = [int(x) for x in os.getenv("SHARD_IDS", "").split(",") if x.strip()]  # Shardy tego procesu; puste = wszystkie
+LEASE_HOLDER = f"{socket.gethostname()}:{os.getpid()}"  # Identyfikator procesu w tabeli leases
 
 intents = discord.Intents.default()
 intents.message_content = True
 intents.reactions = True
 intents.members = True  # Upewnij się, że w panelu dewelopera Discord są włączone
 
-bot = commands.Bot(command_prefix=BOT_PREFIX, intents=intents, help_command=None)
+if SHARD_COUNT > 1:
+    bot = commands.AutoShardedBot(
+        command_prefix=BOT_PREFIX,
+        intents=intents,
+        help_command=None,
+        shard_count=SHARD_COUNT,
+        shard_ids=SHARD_IDS or None
+    )
+else:
+    bot = commands.Bot(command_prefix=BOT_PREFIX, intents=intents, help_command=None)
+
+def owns_guild(guild_id: int) -> bool:
+    # Gildia należy do shardu (guild_id >> 22) % SHARD_COUNT – wzór z dokumentacji Discorda
+    if SHARD_COUNT <= 1 or not SHARD_IDS:
+        return True
+    return (guild_id >> 22) % SHARD_COUNT in SHARD_IDS
 
-VALID_TYPES = {"piwo", "wodka", "whiskey", "wino", "drink", "blunt"}
+SUBSTANCES = ("piwo", "wodka", "whiskey", "wino", "drink", "blunt")  # Kolejność = indeks w tablicach UserStatus
+SUBSTANCE_INDEX = {typ: i for i, typ in enumerate(SUBSTANCES)}
+VALID_TYPES = set(SUBSTANCES)
 
 TIME_TO_EXPIRE = {
     "piwo": 3,
@@ -50,143 +132,2135 @@ EMOJI_TO_TYPE = {
 }
 TYPE_TO_EMOJI = {v: k for k, v in EMOJI_TO_TYPE.items()}
 
-# ---------------------------------------------
-# GLOBALNE ZMIENNE
-# ---------------------------------------------
-user_statuses = {}           # {user_id: {...}}
-status_message_id = None     # ID wiadomości z reakcjami (init_status_message)
-listening_channel_id = None  # Kanał, w którym bot nasłuchuje (opcjonalnie)
-live_leaderboard_message_id = None  # ID wiadomości z live_leaderboard
-live_leaderboard_channel_id = None  # Kanał dla live_leaderboard
-dedicated_channel_id = None  # Dedykowany kanał dla wiadomości z reakcjami i leaderboardu
+# ---------------------------------------------
+# GLOBALNE ZMIENNE
+# ---------------------------------------------
+LEGACY_GUILD_ID = 0          # Dane sprzed podziału na gildie; on_ready przypisuje je właściwej gildii
+guild_states = {}            # {guild_id: GuildState}
+unsaved_changes = False      # Były mutacje od ostatniego zapisu
+expiry_heap = []             # Kopiec (expires_at_ts, guild_id, user_id, typ); nieaktualne wpisy pomijamy przy zdjęciu
+expiry_wakeup = asyncio.Event()  # Budzi planistę, gdy pojawi się wcześniejszy termin
+expiry_task = None           # Zadanie asyncio planisty wygaśnięć
+leaderboard_refresh_task = None  # Oczekujące (debounce) odświeżenie live leaderboardu
+pending_leaderboard_guilds = set()  # Gildie, których live leaderboard czeka na odświeżenie
+reaction_queue = asyncio.Queue()  # Zdarzenia reakcji czekające na zastosowanie w paczce
+reaction_task = None         # Zadanie asyncio przetwarzające paczki reakcji
+acknowledge_tasks = set()    # Zadania zdejmujące reakcje po zastosowaniu paczki
+PROCESS_START = time.perf_counter()  # Punkt odniesienia dla czasów startu
+startup_done = False         # on_ready po reconnectcie nie powtarza inicjalizacji
+startup_timings = {}         # {faza startu: czas w sekundach}
+reconcile_task = None        # Porządki po starcie (wiadomości, nicki) działające w tle
+shutting_down = False        # Trwa graceful_shutdown – kolejne .shutdown są ignorowane
+
+SETTINGS_KEYS = (
+    "status_message_id",         # ID wiadomości z reakcjami (init_status_message)
+    "listening_channel_id",      # Kanał, w którym bot nasłuchuje (opcjonalnie)
+    "dedicated_channel_id",      # Dedykowany kanał dla wiadomości z reakcjami i leaderboardu
+    "live_leaderboard_message_id",  # ID wiadomości z live_leaderboard
+    "live_leaderboard_channel_id",  # Kanał dla live_leaderboard
+    "last_exported_month",          # Ostatni miesiąc wyeksportowany do stats/ i archiwum
+    "pending_nick_restores",        # ID członków, których nicków nie przywrócono przy ostatnim zamknięciu
+    "allowed_channel_ids"           # Kanały, w których działają komendy prefiksowe (oprócz kanału nasłuchu)
+)
+
+class GuildState:
+    """Stan jednej gildii: ustawienia, statusy użytkowników, rankingi i live leaderboard."""
+
+    def __init__(self, guild_id: int):
+        self.guild_id = guild_id
+        self.settings = {key: None for key in SETTINGS_KEYS}
+        self.users = {}                     # {user_id: UserStatus}
+        self.leaderboards = {}              # {month: LeaderboardIndex}
+        self.live_leaderboard_digest = None  # (channel_id, message_id, skrót) ostatnio wysłanego embeda
+        self.member_index = None            # MemberIndex budowany przy pierwszym wyszukiwaniu
+        self.leaderboard_pages = {}         # {month: LeaderboardPages} – wyrenderowane strony rankingu
+        self.rate_bucket = None             # TokenBucket gildii (limit zmian spożycia)
+        self.user_rate_buckets = {}         # {user_id: TokenBucket}
+        self.command_channels = None        # frozenset kanałów komend (None = do przeliczenia po zmianie ustawień)
+        self.snapshot_users = None          # {user_id: kopia UserStatus} z ostatniej kompakcji (None = kopiujemy wszystkich)
+        self.snapshot_stale = set()         # user_id zmienieni od ostatniej kompakcji
+
+def get_guild_state(guild_id: int) -> GuildState:
+    state = guild_states.get(guild_id)
+    if state is None:
+        state = GuildState(guild_id)
+        guild_states[guild_id] = state
+    return state
+
+# ---------------------------------------------
+# ZEGAR (symulator podmienia go na czas symulowany)
+# ---------------------------------------------
+class Clock:
+    """Czas ścienny stanu: terminy wygaśnięć, bieżący miesiąc, znaczniki zdarzeń."""
+
+    def time(self) -> float:
+        return time.time()
+
+    def now(self) -> datetime.datetime:
+        return datetime.datetime.now(timezone.utc)
+
+clock = Clock()
+
+# ---------------------------------------------
+# METRYKI (Prometheus /metrics i komenda .stats)
+# ---------------------------------------------
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class Histogram:
+    __slots__ = ("buckets", "count", "total", "max")
+
+    def __init__(self):
+        self.buckets = [0] * (len(METRICS_BUCKETS) + 1)  # ostatni kubełek = +Inf
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.buckets[bisect.bisect_left(METRICS_BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+class Metrics:
+    """
+    Liczniki i histogramy w pamięci procesu, kluczowane (nazwa, etykiety).
+    Wskaźniki (gauge) i liczniki prowadzone gdzie indziej (counter_func) to
+    funkcje odczytywane dopiero przy renderowaniu.
+    """
+
+    def __init__(self, prefix: str = "alkobot"):
+        self.prefix = prefix
+        self.counters = {}    # {(nazwa, etykiety): wartość}
+        self.histograms = {}  # {(nazwa, etykiety): Histogram}
+        self.gauges = {}      # {nazwa: funkcja}
+        self.counter_funcs = {}  # {nazwa: funkcja} – wartości tylko rosnące
+        self.api_calls = deque()  # Znaczniki czasu wywołań API z ostatniej minuty
+        self.task_ticks = {}  # {zadanie: czas ostatniego przebiegu}
+
+    def inc(self, name: str, amount: int = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def gauge(self, name: str, func):
+        self.gauges[name] = func
+
+    def counter_func(self, name: str, func):
+        self.counter_funcs[name] = func
+
+    def api_call(self, method: str, route: str):
+        self.inc("discord_api_requests_total", method=method, route=route)
+        self.api_calls.append(time.monotonic())
+
+    def api_calls_last_minute(self) -> int:
+        cutoff = time.monotonic() - 60
+        while self.api_calls and self.api_calls[0] < cutoff:
+            self.api_calls.popleft()
+        return len(self.api_calls)
+
+    def task_tick(self, task: str, interval: float):
+        # Opóźnienie pętli tasks.loop względem jej interwału
+        now = time.monotonic()
+        last = self.task_ticks.get(task)
+        self.task_ticks[task] = now
+        if last is not None:
+            self.observe("task_lag_seconds", max(now - last - interval, 0.0), task=task)
+
+    def render(self) -> str:
+        # Format tekstowy Prometheusa (0.0.4)
+        lines = []
+        typed = set()
+
+        def labels_str(labels, extra=()):
+            pairs = [*labels, *extra]
+            if not pairs:
+                return ""
+            escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"') for _, v in pairs)
+            return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+        for (name, labels), value in sorted(self.counters.items()):
+            full = f"{self.prefix}_{name}"
+            if full not in typed:
+                typed.add(full)
+                lines.append(f"# TYPE {full} counter")
+            lines.append(f"{full}{labels_str(labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            full = f"{self.prefix}_{name}"
+            if full not in typed:
+                typed.add(full)
+                lines.append(f"# TYPE {full} histogram")
+            cumulative = 0
+            for bound, count in zip((*METRICS_BUCKETS, "+Inf"), histogram.buckets):
+                cumulative += count
+                lines.append(f"{full}_bucket{labels_str(labels, (('le', bound),))} {cumulative}")
+            lines.append(f"{full}_sum{labels_str(labels)} {histogram.total}")
+            lines.append(f"{full}_count{labels_str(labels)} {histogram.count}")
+        for name, func in sorted(self.counter_funcs.items()):
+            full = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {full} counter")
+            lines.append(f"{full} {func()}")
+        for name, func in sorted(self.gauges.items()):
+            full = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {full} gauge")
+            lines.append(f"{full} {func()}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics_runner = None        # aiohttp AppRunner serwera /metrics
+loop_lag_task = None         # Zadanie mierzące opóźnienie pętli zdarzeń
+
+def timed(name: str):
+    # Dekorator: czas wykonania funkcji (synchronicznej lub async) do histogramu <name>_seconds
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    metrics.observe(f"{name}_seconds", time.perf_counter() - start)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metrics.observe(f"{name}_seconds", time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+def instrument_http():
+    # Każde wywołanie REST API Discorda przechodzi przez HTTPClient.request
+    original = bot.http.request
+
+    async def request(route, **kwargs):
+        metrics.api_call(route.method, route.path)
+        try:
+            return await original(route, **kwargs)
+        except discord.HTTPException as e:
+            metrics.inc("discord_api_errors_total", status=e.status)
+            raise
+
+    bot.http.request = request
+
+async def monitor_loop_lag():
+    # Opóźnienie pętli zdarzeń: o ile później niż zaplanowano budzi się krótki sleep
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(time.perf_counter() - start - LOOP_LAG_INTERVAL, 0.0)
+        metrics.observe("event_loop_lag_seconds", lag)
+
+async def start_metrics_server():
+    global metrics_runner
+    if not METRICS_PORT:
+        return
+
+    async def handle(request):
+        return web.Response(
+            body=metrics.render().encode("utf-8"),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+        )
+
+    # Procesy shardów na jednym hoście dostają kolejne porty (od pierwszego shardu)
+    port = METRICS_PORT + (SHARD_IDS[0] if SHARD_IDS else 0)
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, port).start()
+    except OSError as e:
+        logging.warning(f"Nie udało się uruchomić /metrics na {METRICS_HOST}:{port}: {e}")
+        await runner.cleanup()
+        return
+    metrics_runner = runner
+    logging.info(f"Metryki dostępne na http://{METRICS_HOST}:{port}/metrics")
+
+def build_stats_text() -> str:
+    lines = ["**Metryki bota**"]
+    lines.append(f"Wywołania API Discorda (ostatnia minuta): {metrics.api_calls_last_minute()}")
+    loop_lag = metrics.histograms.get(("event_loop_lag_seconds", ()))
+    if loop_lag and loop_lag.count:
+        lines.append(
+            f"Opóźnienie pętli zdarzeń: śr. {loop_lag.total / loop_lag.count * 1000:.1f} ms, "
+            f"maks. {loop_lag.max * 1000:.1f} ms"
+        )
+    timings = []
+    for (name, labels), histogram in sorted(metrics.histograms.items(), key=lambda item: item[0]):
+        if name == "event_loop_lag_seconds" or not histogram.count:
+            continue
+        label = name[:-len("_seconds")] + "".join(f" [{v}]" for _, v in labels)
+        timings.append(
+            f"  {label}: {histogram.count}× śr. {histogram.total / histogram.count * 1000:.1f} ms, "
+            f"maks. {histogram.max * 1000:.1f} ms"
+        )
+    if timings:
+        lines.append("Czasy:")
+        lines.extend(timings)
+    queue = nickname_queue.stats()
+    lines.append(
+        f"Kolejka nicków: w kolejce {queue['depth']}, zmienione {queue['edited']}, "
+        f"pominięte {queue['skipped']}, scalone {queue['coalesced']}, ponowione {queue['retried']}, błędy {queue['failed']}"
+    )
+    messages = {dict(labels)["result"]: value for (name, labels), value in metrics.counters.items() if name == "messages_total"}
+    if messages:
+        lines.append("Wiadomości: " + ", ".join(f"{result} {count}" for result, count in sorted(messages.items())))
+    if startup_timings:
+        lines.append("Start: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in startup_timings.items()))
+    return "\n".join(lines)
+
+# ---------------------------------------------
+# STATUS UŻYTKOWNIKA
+# ---------------------------------------------
+class UserStatus:
+    """
+    Status jednego użytkownika. Liczniki i terminy wygaśnięcia to tablice
+    o stałej długości indeksowane jak SUBSTANCES; terminy w sekundach epoki
+    (0.0 = brak). Miesięczne liczniki: {miesiąc: tablica jak counts}.
+    """
+    __slots__ = ("original_nick", "counts", "expires", "monthly_usage")
+
+    def __init__(self, original_nick: str = ""):
+        self.original_nick = original_nick
+        self.counts = array("i", bytes(4 * len(SUBSTANCES)))
+        self.expires = array("d", bytes(8 * len(SUBSTANCES)))
+        self.monthly_usage = {}
+
+    def is_idle(self) -> bool:
+        return not any(self.counts)
+
+    def copy(self) -> "UserStatus":
+        status = UserStatus.__new__(UserStatus)
+        status.original_nick = self.original_nick
+        status.counts = array("i", self.counts)
+        status.expires = array("d", self.expires)
+        status.monthly_usage = {month: array("i", stats) for month, stats in self.monthly_usage.items()}
+        return status
+
+    @classmethod
+    def from_compact(cls, data: list, positions: list = None) -> "UserStatus":
+        # Zwarty schemat: [nick, liczniki, terminy (epoch s, 0 = brak), {miesiąc: liczniki}].
+        # positions mapuje pozycję w pliku na indeks w SUBSTANCES (None = ta sama kolejność).
+        nick, counts, expires, monthly = data
+        status = cls(nick or "")
+        if positions is None:
+            status.counts = array("i", counts)
+            status.expires = array("d", expires)
+            status.monthly_usage = {month: array("i", stats) for month, stats in monthly.items()}
+            return status
+        for pos, idx in enumerate(positions):
+            if idx is not None:
+                status.counts[idx] = counts[pos]
+                status.expires[idx] = expires[pos]
+        for month, stats in monthly.items():
+            month_array = status.month_stats(month)
+            for pos, idx in enumerate(positions):
+                if idx is not None:
+                    month_array[idx] = stats[pos]
+        return status
+
+    def to_compact(self) -> list:
+        # Terminy zaokrąglamy w górę do pełnej sekundy – status nie wygaśnie przed czasem
+        return [
+            self.original_nick,
+            self.counts.tolist(),
+            [math.ceil(ts) for ts in self.expires],
+            {month: stats.tolist() for month, stats in self.monthly_usage.items()}
+        ]
+
+    def month_stats(self, month: str) -> array:
+        stats = self.monthly_usage.get(month)
+        if stats is None:
+            stats = array("i", bytes(4 * len(SUBSTANCES)))
+            self.monthly_usage[month] = stats
+        return stats
+
+    @classmethod
+    def from_json(cls, data: dict) -> "UserStatus":
+        # Schemat data.json: liczniki pod nazwami typów, terminy jako ISO 8601.
+        # Brakujące klucze traktujemy jak zera – nie trzeba ich dopisywać przy wczytaniu.
+        status = cls(data.get("original_nick") or "")
+        eps = data.get("expires_per_substance")
+        if not isinstance(eps, dict):
+            eps = {}
+        for i, typ in enumerate(SUBSTANCES):
+            status.counts[i] = data.get(typ, 0) or 0
+            val = eps.get(typ)
+            if val is not None:
+                try:
+                    status.expires[i] = datetime.datetime.fromisoformat(val).timestamp()
+                except (TypeError, ValueError):
+                    pass
+        monthly = data.get("monthly_usage")
+        if isinstance(monthly, dict):
+            for month, stats in monthly.items():
+                month_array = status.month_stats(month)
+                for typ, count in stats.items():
+                    if typ in SUBSTANCE_INDEX:
+                        month_array[SUBSTANCE_INDEX[typ]] = count
+        return status
+
+    def to_json(self) -> dict:
+        data = {"original_nick": self.original_nick}
+        for i, typ in enumerate(SUBSTANCES):
+            data[typ] = self.counts[i]
+        data["monthly_usage"] = {
+            month: dict(zip(SUBSTANCES, stats)) for month, stats in self.monthly_usage.items()
+        }
+        data["expires_per_substance"] = {
+            typ: datetime.datetime.fromtimestamp(ts, timezone.utc).isoformat() if ts else None
+            for typ, ts in zip(SUBSTANCES, self.expires)
+        }
+        return data
+
+# ---------------------------------------------
+# MIGRACJA DANYCH (plik JSON)
+# ---------------------------------------------
+def migrate_raw_data(raw: dict) -> dict:
+    # Stary format: {"settings": {...}, "<user_id>": {...}} – jedna gildia.
+    # Przenosimy go pod LEGACY_GUILD_ID w formacie {"settings": {...}, "guilds": {...}}.
+    if "guilds" not in raw:
+        legacy_settings = raw.pop("settings", {})
+        legacy_users = dict(raw)
+        raw = {"settings": {}, "guilds": {}}
+        if legacy_users or any(v is not None for v in legacy_settings.values()):
+            raw["guilds"][str(LEGACY_GUILD_ID)] = {"settings": legacy_settings, "users": legacy_users}
+    if "settings" not in raw:
+        raw["settings"] = {}
+    for guild_raw in raw["guilds"].values():
+        # Upewnij się, że w sekcji settings są wymagane klucze
+        settings = guild_raw.get("settings", {})
+        for key in SETTINGS_KEYS:
+            if key not in settings:
+                settings[key] = None
+        guild_raw["settings"] = settings
+        # Brakujące klucze użytkowników uzupełnia UserStatus.from_json
+        if "users" not in guild_raw:
+            guild_raw["users"] = {}
+    return raw
+
+# ---------------------------------------------
+# FORMAT SNAPSHOTU (json / compact / msgpack)
+# ---------------------------------------------
+def encode_snapshot(captured: dict, journal_seq: int) -> bytes:
+    # "json" to dotychczasowy układ data.json. "compact" i "msgpack" zapisują statusy
+    # jako listy pozycyjne (kolejność typów w kluczu "substances"), bez wcięć.
+    if DATA_FORMAT == "json":
+        snapshot = build_snapshot(captured)
+        snapshot["settings"]["journal_seq"] = journal_seq
+        return json.dumps(snapshot, ensure_ascii=False, indent=2).encode("utf-8")
+    snapshot = {"substances": list(SUBSTANCES), "settings": {"journal_seq": journal_seq}, "guilds": {}}
+    for guild_id, (settings, users) in captured.items():
+        snapshot["guilds"][str(guild_id)] = {
+            "settings": settings,
+            "users": {str(user_id): status.to_compact() for user_id, status in users.items()}
+        }
+    if DATA_FORMAT == "msgpack" and msgpack is not None:
+        return msgpack.packb(snapshot, use_bin_type=True)
+    return json.dumps(snapshot, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def decode_snapshot(blob: bytes) -> dict:
+    # Format rozpoznajemy po pierwszym bajcie: JSON (oba układy) zaczyna się od "{",
+    # mapa msgpack od 0x80–0x8f / 0xde / 0xdf.
+    head = blob.lstrip()[:1]
+    if head == b"{":
+        return json.loads(blob)
+    if not head:
+        raise ValueError("pusty plik")
+    if msgpack is None:
+        raise ValueError("snapshot w formacie msgpack, a pakiet msgpack nie jest zainstalowany")
+    return msgpack.unpackb(blob, raw=False, strict_map_key=False)
+
+def substance_positions(raw: dict):
+    # Mapowanie pozycji zwartego schematu na bieżące SUBSTANCES (None = bez zmian)
+    layout = raw.get("substances")
+    if layout is None or list(layout) == list(SUBSTANCES):
+        return None
+    return [SUBSTANCE_INDEX.get(typ) for typ in layout]
+
+# ---------------------------------------------
+# WARSTWA PRZECHOWYWANIA (JSON + dziennik / SQLite)
+# ---------------------------------------------
+def ensure_data_file_exists():
+    if not os.path.exists(DATA_FILE):
+        logging.info(f"Plik {DATA_FILE} nie istnieje. Tworzę go.")
+        base_data = {
+            "settings": {},
+            "guilds": {}
+        }
+        with open(DATA_FILE, "w", encoding="utf-8") as f:
+            json.dump(base_data, f, ensure_ascii=False, indent=2)
+
+class JsonStorage:
+    """
+    Snapshot w data.json + dziennik mutacji (append-only) w data.journal.
+    Każdy wpis dziennika ma numer sekwencyjny; snapshot zapamiętuje numer
+    ostatniego zawartego wpisu, więc odtwarzanie jest idempotentne.
+    """
+    name = "json"
+    pending_migration = False  # Migrację z data.json robi tylko SqliteStorage
+
+    def __init__(self, data_file: str, journal_file: str):
+        self.data_file = data_file
+        self.journal_file = journal_file
+        self.rotated_file = journal_file + ".old"  # Dziennik sprzed trwającej kompakcji
+        self.seq = 0          # Numer ostatniej mutacji zapisanej w dzienniku
+        self.entries = 0      # Liczba wpisów w dzienniku od ostatniej kompakcji
+        self.handle = None    # Otwarty plik dziennika (tryb append)
+        if DATA_FORMAT == "msgpack" and msgpack is None:
+            logging.warning("Brak pakietu msgpack – snapshot zapisuję w formacie compact.")
+
+    def load(self):
+        ensure_data_file_exists()
+        try:
+            with open(self.data_file, "rb") as f:
+                raw = decode_snapshot(f.read())
+        except (ValueError, OSError) as e:
+            # Start z pustym stanem skończyłby się kompakcją, która nadpisałaby
+            # jedyną kopię danych – przerywamy start, plik zostaje nietknięty.
+            logging.error(f"Błąd wczytywania {self.data_file}: {e}")
+            raise RuntimeError(
+                f"Nie można odczytać {self.data_file} – przywróć kopię albo usuń plik, aby zacząć od zera."
+            ) from e
+        self.seq = raw.get("settings", {}).pop("journal_seq", 0)
+        # Dziennik obrócony przez niedokończoną kompakcję jest starszy od bieżącego
+        entries = self.read_journal(self.rotated_file) + self.read_journal(self.journal_file)
+        self.entries = len(entries)
+        return raw, entries
+
+    def read_journal(self, path: str) -> list:
+        # Zwraca mutacje zapisane po ostatnim snapshocie. Wpisy z numerem
+        # sekwencyjnym <= seq są już zawarte w snapshocie i je pomijamy,
+        # dzięki czemu awaria między zapisem snapshotu a wyczyszczeniem dziennika
+        # nie powoduje podwójnego naliczenia.
+        if not os.path.exists(path):
+            return []
+        entries = []
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for line_no, line in enumerate(f, start=1):
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Urwany ostatni wpis po awarii – reszta dziennika jest niepewna.
+                        logging.warning(f"Uszkodzony wpis w {path} (linia {line_no}), przerywam odtwarzanie.")
+                        break
+                    seq = entry.get("seq", 0)
+                    if seq <= self.seq:
+                        continue
+                    entries.append(entry)
+                    self.seq = seq
+        except OSError as e:
+            logging.error(f"Błąd odczytu {path}: {e}")
+        return entries
+
+    def record(self, entry: dict):
+        self.seq += 1
+        entry["seq"] = self.seq
+        try:
+            if self.handle is None:
+                self.handle = open(self.journal_file, "a", encoding="utf-8")
+            self.handle.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.handle.flush()
+            self.entries += 1
+        except OSError as e:
+            logging.error(f"Błąd zapisu do {self.journal_file}: {e}")
+
+    def fsync(self, handle):
+        try:
+            os.fsync(handle.fileno())
+        except (OSError, ValueError) as e:
+            logging.error(f"Błąd zapisu do {self.journal_file}: {e}")
+
+    def flush(self):
+        if self.handle is not None:
+            self.fsync(self.handle)
+
+    def flush_job(self):
+        # Wpisy są już w pliku (record robi write+flush) – do wątku idzie tylko fsync
+        handle = self.handle
+        if handle is None:
+            return None
+        return lambda: self.fsync(handle)
+
+    def needs_compaction(self) -> bool:
+        return self.entries >= JOURNAL_COMPACT_THRESHOLD
+
+    def needs_retry(self) -> bool:
+        return False  # Błędy zapisu dziennika tylko logujemy
+
+    def has_pending(self) -> bool:
+        return self.entries > 0
+
+    def compact_job(self, captured: dict):
+        # Na pętli: zamykamy bieżący dziennik (-> .old) i zapamiętujemy seq snapshotu;
+        # nowe mutacje idą już do świeżego pliku. W wątku: serializacja, atomowy
+        # zapis (tmp + rename), fsync i usunięcie .old. Jeśli poprzedni .old nadal
+        # istnieje (nieudany zapis), nie nadpisujemy go – dzięki seq odtwarzanie
+        # i tak pominie wpisy zawarte w snapshocie.
+        seq = self.seq
+        handle = self.handle
+        self.handle = None
+        if not os.path.exists(self.rotated_file) and os.path.exists(self.journal_file):
+            try:
+                os.replace(self.journal_file, self.rotated_file)
+            except OSError as e:
+                logging.error(f"Błąd obracania {self.journal_file}: {e}")
+        self.entries = 0
+
+        def job():
+            if handle is not None:
+                self.fsync(handle)
+                handle.close()
+            blob = encode_snapshot(captured, seq)
+            tmp_path = self.data_file + ".tmp"
+            try:
+                with open(tmp_path, "wb") as f:
+                    f.write(blob)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.data_file)
+            except OSError as e:
+                logging.error(f"Błąd zapisu do {self.data_file}: {e}")
+                return
+            # Snapshot zawiera już wszystko do seq – stary dziennik (także pozostały
+            # po wcześniejszej awarii) nie jest potrzebny
+            if os.path.exists(self.rotated_file):
+                try:
+                    os.remove(self.rotated_file)
+                except OSError as e:
+                    logging.error(f"Błąd usuwania {self.rotated_file}: {e}")
+            logging.info(f"Dane zapisano do {self.data_file} (kompakcja dziennika).")
+
+        return job
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+class SqliteStorage:
+    """
+    Baza SQLite w trybie WAL. record() tylko kolejkuje mutację; SQL wykonuje
+    wątek zapisu (PersistenceService), paczka mutacji = jedna transakcja.
+    Historia spożycia (usage_events, monthly_totals) nie jest
+    usuwana przy eksporcie miesiąca, więc można o nią pytać wstecz.
+    """
+    name = "sqlite"
+    SCHEMA_VERSION = 2
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS settings (
+        guild_id INTEGER NOT NULL,
+        key TEXT NOT NULL,
+        value TEXT,
+        PRIMARY KEY (guild_id, key)
+    );
+    CREATE TABLE IF NOT EXISTS users (
+        guild_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        original_nick TEXT NOT NULL DEFAULT '',
+        PRIMARY KEY (guild_id, user_id)
+    );
+    CREATE TABLE IF NOT EXISTS user_counters (
+        guild_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        typ TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        expires_at TEXT,
+        PRIMARY KEY (guild_id, user_id, typ)
+    );
+    CREATE TABLE IF NOT EXISTS usage_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        guild_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        month TEXT NOT NULL,
+        typ TEXT NOT NULL,
+        amount INTEGER NOT NULL,
+        created_at TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS monthly_usage (
+        guild_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        month TEXT NOT NULL,
+        typ TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (guild_id, user_id, month, typ)
+    );
+    CREATE TABLE IF NOT EXISTS monthly_totals (
+        guild_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        month TEXT NOT NULL,
+        total INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (guild_id, user_id, month)
+    );
+    CREATE INDEX IF NOT EXISTS idx_usage_events_user ON usage_events (user_id, month);
+    CREATE INDEX IF NOT EXISTS idx_monthly_totals_rank ON monthly_totals (guild_id, month, total DESC);
+    """
+
+    def __init__(self, db_file: str):
+        self.db_file = db_file
+        self.conn = None
+        self.pending = []            # Mutacje czekające na zapis (dopisuje pętla)
+        self.retry = []              # Paczka wycofana po błędzie – idzie na początek następnej
+        self.pending_migration = False
+
+    def connect(self):
+        if self.conn is None:
+            # Przy shardingu bazę dzielą procesy (timeout na blokadę). Po starcie
+            # połączenia używa już tylko wątek zapisu, stąd check_same_thread=False.
+            self.conn = sqlite3.connect(self.db_file, timeout=10, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.migrate_schema()
+            self.conn.executescript(self.SCHEMA)
+            self.conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+        return self.conn
+
+    def migrate_schema(self):
+        # Wersja 1 nie miała guild_id w settings/users/user_counters –
+        # przenosimy te wiersze pod LEGACY_GUILD_ID (przypisanie gildii robi adopt_legacy).
+        conn = self.conn
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= self.SCHEMA_VERSION:
+            return
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(users)")]
+        if not columns or "guild_id" in columns:
+            return
+        logging.info(f"Migruję schemat {self.db_file} do wersji {self.SCHEMA_VERSION}.")
+        conn.executescript(
+            "BEGIN;"
+            "ALTER TABLE settings RENAME TO settings_v1;"
+            "ALTER TABLE users RENAME TO users_v1;"
+            "ALTER TABLE user_counters RENAME TO user_counters_v1;"
+            + self.SCHEMA +
+            f"INSERT INTO settings (guild_id, key, value) SELECT {LEGACY_GUILD_ID}, key, value FROM settings_v1;"
+            f"INSERT INTO users (guild_id, user_id, original_nick) "
+            f"SELECT {LEGACY_GUILD_ID}, user_id, original_nick FROM users_v1;"
+            f"INSERT INTO user_counters (guild_id, user_id, typ, count, expires_at) "
+            f"SELECT {LEGACY_GUILD_ID}, user_id, typ, count, expires_at FROM user_counters_v1;"
+            "DROP TABLE settings_v1;"
+            "DROP TABLE users_v1;"
+            "DROP TABLE user_counters_v1;"
+            "COMMIT;"
+        )
+
+    def is_empty(self) -> bool:
+        conn = self.connect()
+        users = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        settings = conn.execute("SELECT COUNT(*) FROM settings").fetchone()[0]
+        return users == 0 and settings == 0
+
+    def load(self):
+        if self.is_empty() and os.path.exists(DATA_FILE):
+            # Jednorazowa migracja: czytamy data.json (z dziennikiem) tak jak
+            # backend JSON, a load_data po odtworzeniu stanu wgrywa go przez migrate().
+            # Przy shardingu migruje jeden proces – reszta czeka na dzierżawę
+            # i po jej zwolnieniu zastaje pełną bazę.
+            while not leases.acquire_sync("migrate", MIGRATION_LEASE_TTL):
+                logging.info(f"Inny proces migruje {DATA_FILE} do {self.db_file} – czekam.")
+                time.sleep(1)
+            if self.is_empty():
+                logging.info(f"Baza {self.db_file} jest pusta – migruję dane z {DATA_FILE}.")
+                self.pending_migration = True
+                try:
+                    return JsonStorage(DATA_FILE, JOURNAL_FILE).load()
+                except RuntimeError:
+                    leases.release_sync("migrate")
+                    raise
+            leases.release_sync("migrate")
+        conn = self.connect()
+        raw = {"settings": {}, "guilds": {}}
+
+        def user_raw(guild_id, user_id):
+            # Wiersze liczników bez wiersza w users (np. sprzed migracji schematu) też tworzą wpis.
+            guild_raw = raw["guilds"].setdefault(str(guild_id), {"settings": {}, "users": {}})
+            return guild_raw["users"].setdefault(str(user_id), {
+                "original_nick": "",
+                "monthly_usage": {},
+                "expires_per_substance": {}
+            })
+
+        where, params = self.owned_guilds_filter()
+        for guild_id, key, value in conn.execute("SELECT guild_id, key, value FROM settings" + where, params):
+            raw["guilds"].setdefault(str(guild_id), {"settings": {}, "users": {}})["settings"][key] = json.loads(value)
+        for guild_id, user_id, original_nick in conn.execute(
+            "SELECT guild_id, user_id, original_nick FROM users" + where, params
+        ):
+            user_raw(guild_id, user_id)["original_nick"] = original_nick
+        for guild_id, user_id, typ, count, expires_at in conn.execute(
+            "SELECT guild_id, user_id, typ, count, expires_at FROM user_counters" + where, params
+        ):
+            data = user_raw(guild_id, user_id)
+            data[typ] = count
+            data["expires_per_substance"][typ] = expires_at
+        for guild_id, user_id, month, typ, count in conn.execute(
+            "SELECT guild_id, user_id, month, typ, count FROM monthly_usage" + where, params
+        ):
+            user_raw(guild_id, user_id)["monthly_usage"].setdefault(month, {})[typ] = count
+        return raw, []
+
+    def owned_guilds_filter(self) -> tuple:
+        # owns_guild w SQL (plus LEGACY_GUILD_ID): wiersze gildii innych shardów
+        # nie trafiają do pamięci procesu
+        if SHARD_COUNT <= 1 or not SHARD_IDS:
+            return "", ()
+        marks = ", ".join("?" * len(SHARD_IDS))
+        return f" WHERE guild_id = ? OR (guild_id >> 22) % ? IN ({marks})", (LEGACY_GUILD_ID, SHARD_COUNT, *SHARD_IDS)
+
+    def record(self, entry: dict):
+        self.pending.append(entry)
+
+    def execute(self, conn, entry: dict):
+        op = entry["op"]
+        guild_id = entry.get("guild", LEGACY_GUILD_ID)
+        if op == "settings":
+            conn.execute(
+                "INSERT INTO settings (guild_id, key, value) VALUES (?, ?, ?) "
+                "ON CONFLICT(guild_id, key) DO UPDATE SET value = excluded.value",
+                (guild_id, entry["key"], json.dumps(entry["value"]))
+            )
+        elif op == "usage":
+            user_id, typ, amount, month = entry["user"], entry["typ"], entry["amount"], entry["month"]
+            conn.execute(
+                "INSERT OR IGNORE INTO users (guild_id, user_id, original_nick) VALUES (?, ?, ?)",
+                (guild_id, user_id, entry.get("nick", ""))
+            )
+            conn.execute(
+                "INSERT INTO user_counters (guild_id, user_id, typ, count, expires_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(guild_id, user_id, typ) DO UPDATE SET count = count + excluded.count, "
+                "expires_at = excluded.expires_at",
+                (guild_id, user_id, typ, amount, entry["expires"])
+            )
+            conn.execute(
+                "INSERT INTO usage_events (guild_id, user_id, month, typ, amount, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (guild_id, user_id, month, typ, amount, entry.get("at") or clock.now().isoformat())
+            )
+            conn.execute(
+                "INSERT INTO monthly_usage (guild_id, user_id, month, typ, count) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(guild_id, user_id, month, typ) DO UPDATE SET count = count + excluded.count",
+                (guild_id, user_id, month, typ, amount)
+            )
+            conn.execute(
+                "INSERT INTO monthly_totals (guild_id, user_id, month, total) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(guild_id, user_id, month) DO UPDATE SET total = total + excluded.total",
+                (guild_id, user_id, month, amount)
+            )
+        elif op == "expire":
+            conn.execute(
+                "UPDATE user_counters SET count = 0, expires_at = NULL "
+                "WHERE guild_id = ? AND user_id = ? AND typ = ?",
+                (guild_id, entry["user"], entry["typ"])
+            )
+        elif op == "clear":
+            conn.execute(
+                "UPDATE user_counters SET count = 0, expires_at = NULL WHERE guild_id = ? AND user_id = ?",
+                (guild_id, entry["user"])
+            )
+        elif op == "nick":
+            # Jak apply_mutation: nick zmieniamy tylko istniejącemu użytkownikowi
+            conn.execute(
+                "UPDATE users SET original_nick = ? WHERE guild_id = ? AND user_id = ?",
+                (entry["value"], guild_id, entry["user"])
+            )
+        elif op == "drop_month":
+            # Bieżące liczniki miesiąca znikają, ale usage_events i monthly_totals zostają.
+            conn.execute(
+                "DELETE FROM monthly_usage WHERE guild_id = ? AND month = ?",
+                (guild_id, entry["month"])
+            )
+        elif op == "adopt_legacy":
+            self.adopt_legacy(conn, guild_id)
+
+    def adopt_legacy(self, conn, guild_id: int):
+        # Scala wiersze LEGACY_GUILD_ID z gildią docelową (tak samo jak merge_legacy_state).
+        params = (guild_id, LEGACY_GUILD_ID)
+        conn.execute(
+            "INSERT INTO settings (guild_id, key, value) SELECT ?, key, value FROM settings WHERE guild_id = ? "
+            "ON CONFLICT(guild_id, key) DO UPDATE SET value = excluded.value WHERE settings.value = 'null'",
+            params
+        )
+        conn.execute(
+            "INSERT INTO users (guild_id, user_id, original_nick) "
+            "SELECT ?, user_id, original_nick FROM users WHERE guild_id = ? "
+            "ON CONFLICT(guild_id, user_id) DO NOTHING",
+            params
+        )
+        conn.execute(
+            "INSERT INTO user_counters (guild_id, user_id, typ, count, expires_at) "
+            "SELECT ?, user_id, typ, count, expires_at FROM user_counters WHERE guild_id = ? "
+            "ON CONFLICT(guild_id, user_id, typ) DO UPDATE SET count = count + excluded.count, "
+            "expires_at = CASE WHEN excluded.expires_at IS NULL THEN user_counters.expires_at "
+            "WHEN user_counters.expires_at IS NULL THEN excluded.expires_at "
+            "ELSE MAX(user_counters.expires_at, excluded.expires_at) END",
+            params
+        )
+        conn.execute(
+            "INSERT INTO monthly_usage (guild_id, user_id, month, typ, count) "
+            "SELECT ?, user_id, month, typ, count FROM monthly_usage WHERE guild_id = ? "
+            "ON CONFLICT(guild_id, user_id, month, typ) DO UPDATE SET count = count + excluded.count",
+            params
+        )
+        conn.execute(
+            "INSERT INTO monthly_totals (guild_id, user_id, month, total) "
+            "SELECT ?, user_id, month, total FROM monthly_totals WHERE guild_id = ? "
+            "ON CONFLICT(guild_id, user_id, month) DO UPDATE SET total = total + excluded.total",
+            params
+        )
+        conn.execute("UPDATE usage_events SET guild_id = ? WHERE guild_id = ?", params)
+        for table in ("settings", "users", "user_counters", "monthly_usage", "monthly_totals"):
+            conn.execute(f"DELETE FROM {table} WHERE guild_id = ?", (LEGACY_GUILD_ID,))
+
+    def write_batch(self, batch: list):
+        # W wątku zapisu. Błąd (np. baza zablokowana przez inny proces dłużej niż
+        # timeout) wycofuje całą transakcję, a paczka czeka na ponowienie –
+        # baza dogania stan w pamięci przy następnej udanej próbie.
+        try:
+            conn = self.connect()
+            with conn:
+                for entry in batch:
+                    self.execute(conn, entry)
+        except sqlite3.Error as e:
+            logging.error(f"Błąd zapisu do {self.db_file} ({len(batch)} mutacji, ponowię): {e}")
+            self.retry = batch
+            metrics.inc("storage_write_retries_total")
+
+    def flush(self):
+        job = self.flush_job()
+        if job is not None:
+            job()
+
+    def flush_job(self):
+        # Paczkę zabieramy na pętli; wątek nie dotyka listy, do której pętla dopisuje
+        if not self.pending and not self.retry:
+            return None
+        batch = self.retry + self.pending
+        self.retry = []
+        self.pending = []
+        return lambda: self.write_batch(batch)
+
+    def needs_retry(self) -> bool:
+        return bool(self.retry)
+
+    def needs_compaction(self) -> bool:
+        return False  # Baza jest zawsze pełna – snapshotu nie robimy
+
+    def has_pending(self) -> bool:
+        return self.pending_migration or bool(self.pending) or bool(self.retry)
+
+    def compact_job(self, captured: dict):
+        # Zaległe mutacje zapisał już flush_job z tego samego przebiegu
+        return self.checkpoint
+
+    def checkpoint(self):
+        try:
+            self.connect().execute("PRAGMA wal_checkpoint(PASSIVE)")
+        except sqlite3.Error as e:
+            logging.warning(f"Checkpoint {self.db_file} nie powiódł się: {e}")
+
+    def migrate(self, snapshot: dict):
+        # Synchronicznie i w jednej transakcji, pod dzierżawą z load(): baza nigdy
+        # nie zawiera części data.json. Błąd przerywa start – pusta baza zostaje
+        # i następna próba migruje od nowa.
+        try:
+            self.import_snapshot(snapshot)
+        finally:
+            leases.release_sync("migrate")
+        self.pending_migration = False
+        logging.info(f"Zmigrowano dane z {DATA_FILE} do {self.db_file} (gildie: {len(snapshot['guilds'])}).")
+
+    def import_snapshot(self, snapshot: dict):
+        # Wgrywa cały stan w schemacie data.json (wynik build_snapshot) w jednej transakcji.
+        conn = self.connect()
+        with conn:
+            for guild_id_str, guild_raw in snapshot.get("guilds", {}).items():
+                guild_id = int(guild_id_str)
+                for key, value in guild_raw["settings"].items():
+                    conn.execute(
+                        "INSERT OR REPLACE INTO settings (guild_id, key, value) VALUES (?, ?, ?)",
+                        (guild_id, key, json.dumps(value))
+                    )
+                for user_id_str, data in guild_raw["users"].items():
+                    user_id = int(user_id_str)
+                    conn.execute(
+                        "INSERT OR REPLACE INTO users (guild_id, user_id, original_nick) VALUES (?, ?, ?)",
+                        (guild_id, user_id, data.get("original_nick", ""))
+                    )
+                    for typ in VALID_TYPES:
+                        conn.execute(
+                            "INSERT OR REPLACE INTO user_counters (guild_id, user_id, typ, count, expires_at) "
+                            "VALUES (?, ?, ?, ?, ?)",
+                            (guild_id, user_id, typ, data.get(typ, 0), data["expires_per_substance"].get(typ))
+                        )
+                    for month, stats in data.get("monthly_usage", {}).items():
+                        for typ, count in stats.items():
+                            conn.execute(
+                                "INSERT OR REPLACE INTO monthly_usage (guild_id, user_id, month, typ, count) "
+                                "VALUES (?, ?, ?, ?, ?)",
+                                (guild_id, user_id, month, typ, count)
+                            )
+                        conn.execute(
+                            "INSERT OR REPLACE INTO monthly_totals (guild_id, user_id, month, total) "
+                            "VALUES (?, ?, ?, ?)",
+                            (guild_id, user_id, month, sum(stats.values()))
+                        )
+
+    def close(self):
+        if self.conn is not None:
+            self.flush()
+            self.conn.close()
+            self.conn = None
+
+class LeaseStore:
+    """
+    Wybór lidera dla zadań, które nie mogą ruszyć w dwóch procesach naraz.
+    Dzierżawa to wiersz (nazwa, właściciel, wygasa) we wspólnej bazie; przejąć
+    ją można tylko po wygaśnięciu, a właściciel odnawia ją przy każdym przebiegu.
+    Z pętli zdarzeń – acquire/release w wątku zapisu (po commitach SqliteStorage);
+    wersje *_sync tylko przy starcie.
+    """
+
+    def __init__(self, db_file: str, holder: str):
+        self.db_file = db_file
+        self.holder = holder
+        self.conn = None
+
+    def connect(self):
+        if self.conn is None:
+            # Osobne połączenie w trybie autocommit – nie miesza się z transakcją SqliteStorage
+            self.conn = sqlite3.connect(self.db_file, timeout=10, isolation_level=None, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS leases ("
+                "name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+        return self.conn
+
+    async def acquire(self, name: str, ttl: float = LEASE_TTL) -> bool:
+        return await asyncio.get_running_loop().run_in_executor(persistence.executor, self.acquire_sync, name, ttl)
+
+    async def release(self, name: str):
+        await asyncio.get_running_loop().run_in_executor(persistence.executor, self.release_sync, name)
+
+    def acquire_sync(self, name: str, ttl: float = LEASE_TTL) -> bool:
+        now = time.time()
+        try:
+            conn = self.connect()
+            conn.execute(
+                "INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at "
+                "WHERE leases.holder = excluded.holder OR leases.expires_at < ?",
+                (name, self.holder, now + ttl, now)
+            )
+            row = conn.execute("SELECT holder FROM leases WHERE name = ?", (name,)).fetchone()
+        except sqlite3.Error as e:
+            logging.warning(f"Nie udało się pobrać dzierżawy {name}: {e}")
+            return False
+        held = row is not None and row[0] == self.holder
+        metrics.inc("lease_acquire_total", job=name.split(":")[0], result="held" if held else "busy")
+        return held
+
+    def release_sync(self, name: str):
+        try:
+            self.connect().execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, self.holder))
+        except sqlite3.Error as e:
+            logging.warning(f"Nie udało się zwolnić dzierżawy {name}: {e}")
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.execute("DELETE FROM leases WHERE holder = ?", (self.holder,))
+            except sqlite3.Error:
+                pass
+            self.conn.close()
+            self.conn = None
+
+class LocalLeases:
+    # Jeden proces – każda dzierżawa jest jego
+    async def acquire(self, name: str, ttl: float = LEASE_TTL) -> bool:
+        return True
+
+    async def release(self, name: str):
+        pass
+
+    def acquire_sync(self, name: str, ttl: float = LEASE_TTL) -> bool:
+        return True
+
+    def release_sync(self, name: str):
+        pass
+
+    def close(self):
+        pass
+
+def create_storage():
+    if STORAGE_BACKEND == "sqlite":
+        return SqliteStorage(SQLITE_FILE)
+    if SHARD_COUNT > 1:
+        logging.warning(f"Sharding wymaga wspólnego stanu – używam backendu sqlite ({SQLITE_FILE}) zamiast {STORAGE_BACKEND}.")
+        return SqliteStorage(SQLITE_FILE)
+    return JsonStorage(DATA_FILE, JOURNAL_FILE)
+
+storage = create_storage()
+leases = LeaseStore(SQLITE_FILE, LEASE_HOLDER) if SHARD_COUNT > 1 else LocalLeases()
+
+class EventLog:
+    """
+    Zdarzenia wejściowe (spożycie, czyszczenie, ustawienia, nicki) z czasem
+    zegara bota. Skutki uboczne – wygaśnięcia, eksport miesiąca – pomijamy:
+    symulator odtwarza je sam z upływu czasu.
+    """
+    ops = ("usage", "clear", "settings", "nick")
+    derived_settings = ("last_exported_month", "pending_nick_restores")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.handle = None
+
+    def record(self, entry: dict):
+        if entry.get("op") not in self.ops or entry.get("key") in self.derived_settings:
+            return
+        try:
+            if self.handle is None:
+                self.handle = open(self.path, "a", encoding="utf-8", buffering=1)
+            # "at" dziennika zdarzeń to sekundy epoki – nadpisuje znacznik ISO z wpisu "usage"
+            self.handle.write(json.dumps({**entry, "at": clock.time()}, ensure_ascii=False) + "\n")
+        except OSError as e:
+            logging.error(f"Błąd zapisu do {self.path}: {e}")
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+event_log = EventLog(EVENT_LOG_FILE) if EVENT_LOG_FILE else None
+
+# ---------------------------------------------
+# ARCHIWUM SPOŻYCIA (kolumnowe, z sumami dziennymi)
+# ---------------------------------------------
+ARCHIVE_EVENT = struct.Struct("<qBBi")  # user_id, dzień, indeks typu, ilość
+ARCHIVE_HEADER = struct.Struct("<4sHxxII")  # magia, wersja, wiersze, użytkownicy
+ARCHIVE_MAGIC = b"ALKA"
+ARCHIVE_VERSION = 1
+
+class MonthArchive:
+    """
+    Zamknięty miesiąc jednej gildii, zmapowany z pliku <miesiąc>.days.
+    Po nagłówku leżą kolumny: posortowane user_id, początki wierszy każdego
+    użytkownika, jego sumy per substancja, sumy dzienne per substancja
+    (dzień 0 = nieznany) i wiersze (ilość, dzień, typ). Kolumny czytamy przez
+    memoryview, bez kopiowania i bez ładowania całego pliku.
+    """
+
+    def __init__(self, path: str):
+        self.file = open(path, "rb")
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, rows, users = ARCHIVE_HEADER.unpack_from(self.mm, 0)
+        if magic != ARCHIVE_MAGIC or version != ARCHIVE_VERSION:
+            self.close()
+            raise ValueError(f"Nieznany format archiwum: {path}")
+        self.view = memoryview(self.mm)
+        self.offset = ARCHIVE_HEADER.size
+        width = len(SUBSTANCES)
+        self.user_ids = self.column("q", users)
+        self.row_start = self.column("I", users + 1)
+        self.user_totals = self.column("i", users * width)
+        self.day_totals = self.column("i", 32 * width)
+        self.row_count = self.column("i", rows)
+        self.row_day = self.column("B", rows)
+        self.row_typ = self.column("B", rows)
+
+    def column(self, fmt: str, length: int) -> memoryview:
+        size = struct.calcsize(fmt) * length
+        col = self.view[self.offset:self.offset + size].cast(fmt)
+        self.offset += size
+        return col
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def find(self, user_id: int) -> int:
+        pos = bisect.bisect_left(self.user_ids, user_id)
+        if pos < len(self.user_ids) and self.user_ids[pos] == user_id:
+            return pos
+        return -1
+
+    def totals(self, pos: int) -> memoryview:
+        width = len(SUBSTANCES)
+        return self.user_totals[pos * width:(pos + 1) * width]
+
+    def user_days(self, user_id: int):
+        # (dzień, typ, ilość) dla jednego użytkownika
+        pos = self.find(user_id)
+        if pos < 0:
+            return
+        for row in range(self.row_start[pos], self.row_start[pos + 1]):
+            yield self.row_day[row], SUBSTANCES[self.row_typ[row]], self.row_count[row]
+
+    def close(self):
+        # memoryview trzymają bufor mmap – zwalniamy je przed zamknięciem
+        for name in ("user_ids", "row_start", "user_totals", "day_totals", "row_count", "row_day", "row_typ", "view"):
+            view = getattr(self, name, None)
+            if view is not None:
+                view.release()
+        self.mm.close()
+        self.file.close()
+
+def write_month_archive(path: str, rows: list):
+    # rows: (user_id, dzień, indeks typu, ilość), dowolna kolejność
+    rows.sort()
+    width = len(SUBSTANCES)
+    user_ids = array("q")
+    row_start = array("I")
+    user_totals = array("i")
+    day_totals = array("i", bytes(4 * 32 * width))
+    for pos, (user_id, day, idx, count) in enumerate(rows):
+        if not user_ids or user_ids[-1] != user_id:
+            user_ids.append(user_id)
+            row_start.append(pos)
+            user_totals.extend([0] * width)
+        user_totals[(len(user_ids) - 1) * width + idx] += count
+        day_totals[day * width + idx] += count
+    row_start.append(len(rows))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, len(rows), len(user_ids)))
+        f.write(user_ids.tobytes())
+        f.write(row_start.tobytes())
+        f.write(user_totals.tobytes())
+        f.write(day_totals.tobytes())
+        f.write(array("i", (r[3] for r in rows)).tobytes())
+        f.write(bytes(r[1] for r in rows))
+        f.write(bytes(r[2] for r in rows))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class UsageArchive:
+    """
+    Archiwum spożycia: archive/<gildia>/<miesiąc>.events (zdarzenia dopisywane
+    w trakcie miesiąca) i <miesiąc>.days (zamknięty miesiąc, patrz MonthArchive).
+    Zapytania historyczne czytają tylko pliki .days, bez ładowania do guild_states.
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.pending = []  # (guild_id, miesiąc, rekord ARCHIVE_EVENT) do dopisania w flush()
+        self.months = {}   # {(guild_id, miesiąc): MonthArchive}
+
+    def path(self, guild_id: int, month: str, ext: str) -> str:
+        return os.path.join(self.folder, str(guild_id), f"{month}.{ext}")
+
+    def record(self, guild_id: int, user_id: int, typ: str, amount: int, when: datetime.datetime):
+        event = ARCHIVE_EVENT.pack(user_id, when.day, SUBSTANCE_INDEX[typ], amount)
+        self.pending.append((guild_id, when.strftime("%Y-%m"), event))
+
+    def flush(self):
+        job = self.flush_job()
+        if job is not None:
+            job()
+
+    def flush_job(self):
+        # Zabieramy bufor na pętli, dopisanie do plików może zrobić wątek
+        if not self.pending:
+            return None
+        pending, self.pending = self.pending, []
+        return lambda: self.write_events(pending)
+
+    def write_events(self, pending: list):
+        grouped = {}
+        for guild_id, month, event in pending:
+            grouped.setdefault((guild_id, month), []).append(event)
+        for (guild_id, month), events in grouped.items():
+            path = self.path(guild_id, month, "events")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "ab") as f:
+                f.write(b"".join(events))
+
+    def read_events(self, guild_id: int, month: str) -> dict:
+        # {(user_id, indeks typu): {dzień: ilość}}; niepełny rekord z końca pliku pomijamy
+        path = self.path(guild_id, month, "events")
+        result = {}
+        if not os.path.exists(path):
+            return result
+        with open(path, "rb") as f:
+            data = f.read()
+        usable = len(data) - len(data) % ARCHIVE_EVENT.size
+        for user_id, day, idx, amount in ARCHIVE_EVENT.iter_unpack(data[:usable]):
+            days = result.setdefault((user_id, idx), {})
+            days[day] = days.get(day, 0) + amount
+        return result
+
+    def close_month(self, guild_id: int, month: str, usage: dict) -> str:
+        # usage: {user_id: liczniki miesiąca} – kopia zrobiona w pętli zdarzeń, bo
+        # ta metoda może działać w wątku. Wcześniej trzeba wywołać flush() i evict().
+        # Źródłem prawdy są liczniki miesiąca – zdarzenia dają tylko rozkład na dni.
+        # To, czego w zdarzeniach brakuje (np. spożycie sprzed archiwum), trafia
+        # do dnia 0, więc sumy zawsze zgadzają się z rankingiem.
+        events = self.read_events(guild_id, month)
+        rows = []
+        for user_id, stats in usage.items():
+            for idx, total in enumerate(stats):
+                left = total
+                days = events.get((user_id, idx), {})
+                for day in sorted(days):
+                    count = min(days[day], left)
+                    if count > 0:
+                        rows.append((user_id, day, idx, count))
+                        left -= count
+                if left > 0:
+                    rows.append((user_id, 0, idx, left))
+        path = self.path(guild_id, month, "days")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_month_archive(path, rows)
+        return path
+
+    def evict(self, guild_id: int, month: str):
+        cached = self.months.pop((guild_id, month), None)
+        if cached is not None:
+            cached.close()
+
+    def discard_events(self, guild_id: int, month: str):
+        # Wołane dopiero po utrwaleniu drop_month – do tego czasu zdarzenia są potrzebne
+        path = self.path(guild_id, month, "events")
+        if os.path.exists(path):
+            os.remove(path)
+
+    def archived_months(self, guild_id: int, year: str = None) -> list:
+        folder = os.path.join(self.folder, str(guild_id))
+        if not os.path.isdir(folder):
+            return []
+        months = [name[:-5] for name in os.listdir(folder) if name.endswith(".days")]
+        if year is not None:
+            months = [m for m in months if m.startswith(f"{year}-")]
+        return sorted(months)
+
+    def month(self, guild_id: int, month: str) -> MonthArchive:
+        key = (guild_id, month)
+        archive = self.months.get(key)
+        if archive is None:
+            archive = MonthArchive(self.path(guild_id, month, "days"))
+            self.months[key] = archive
+        return archive
+
+    def user_totals(self, guild_id: int, user_id: int, year: str = None) -> array:
+        # Sumy per substancja użytkownika w roku (albo z całej historii)
+        totals = array("i", bytes(4 * len(SUBSTANCES)))
+        for month in self.archived_months(guild_id, year):
+            archive = self.month(guild_id, month)
+            pos = archive.find(user_id)
+            if pos >= 0:
+                for idx, count in enumerate(archive.totals(pos)):
+                    totals[idx] += count
+        return totals
+
+    def substance_trend(self, guild_id: int, typ: str, year: str = None) -> list:
+        # [(miesiąc, [suma z dnia 0, 1, ..., 31])] dla jednej substancji
+        idx = SUBSTANCE_INDEX[typ]
+        width = len(SUBSTANCES)
+        trend = []
+        for month in self.archived_months(guild_id, year):
+            day_totals = self.month(guild_id, month).day_totals
+            trend.append((month, [day_totals[day * width + idx] for day in range(32)]))
+        return trend
+
+    def leaderboard(self, guild_id: int, year: str = None, limit: int = 10) -> list:
+        # [(user_id, sumy per substancja, suma)] – ranking wszech czasów (albo roku)
+        totals = {}
+        for month in self.archived_months(guild_id, year):
+            archive = self.month(guild_id, month)
+            for pos in range(len(archive)):
+                user_id = archive.user_ids[pos]
+                acc = totals.get(user_id)
+                if acc is None:
+                    acc = totals[user_id] = array("i", bytes(4 * len(SUBSTANCES)))
+                for idx, count in enumerate(archive.totals(pos)):
+                    acc[idx] += count
+        ranking = heapq.nlargest(limit, totals.items(), key=lambda item: (sum(item[1]), -item[0]))
+        return [(user_id, stats, sum(stats)) for user_id, stats in ranking]
+
+    def close(self):
+        self.flush()
+        for archive in self.months.values():
+            archive.close()
+        self.months.clear()
+
+usage_archive = UsageArchive(ARCHIVE_FOLDER)
+
+# ---------------------------------------------
+# ŁADOWANIE / ZAPIS DANYCH
+# ---------------------------------------------
+def load_data():
+    global unsaved_changes
+    raw, entries = storage.load()
+    raw = migrate_raw_data(raw)
+    positions = substance_positions(raw)
+    guild_states.clear()
+    for guild_id_str, guild_raw in raw["guilds"].items():
+        try:
+            guild_id = int(guild_id_str)
+        except ValueError:
+            continue
+        state = get_guild_state(guild_id)
+        for key in SETTINGS_KEYS:
+            state.settings[key] = guild_raw["settings"].get(key)
+        for user_id_str, data in guild_raw["users"].items():
+            try:
+                user_id = int(user_id_str)
+            except ValueError:
+                continue
+            if isinstance(data, list):
+                state.users[user_id] = UserStatus.from_compact(data, positions)
+            else:
+                state.users[user_id] = UserStatus.from_json(data)
+    for entry in entries:
+        apply_mutation(entry)
+    unsaved_changes = False
+    rebuild_expiry_heap()
+    for state in guild_states.values():
+        rebuild_leaderboard_indexes(state)
+    logging.info(f"Dane zostały wczytane (backend: {storage.name}, gildie: {len(guild_states)}).")
+    if entries:
+        logging.info(f"Odtworzono {len(entries)} wpisów z dziennika {JOURNAL_FILE}.")
+    if storage.pending_migration:
+        # Całe data.json – także gildie innych shardów – musi trafić do bazy przed
+        # odfiltrowaniem cudzych gildii poniżej
+        storage.migrate(build_snapshot())
+    if entries or storage.needs_compaction():
+        compact_data()
+    # Przy shardingu trzymamy tylko gildie własnych shardów – resztą zajmują się
+    # inne procesy (SQLite pomija je już przy odczycie; tu zostaje data.json i migracja).
+    # Wpisy w kopcu wygaśnięć dla obcych gildii zostaną pominięte.
+    for guild_id in list(guild_states):
+        if guild_id != LEGACY_GUILD_ID and not owns_guild(guild_id):
+            del guild_states[guild_id]
+
+def capture_snapshot() -> dict:
+    # Tania kopia stanu na pętli: słowniki ustawień i kopie UserStatus. Kopie
+    # trzymamy w GuildState.snapshot_users i odświeżamy tylko zmienionych od
+    # poprzedniej kompakcji; kopii w lustrze nikt nie modyfikuje, więc wątek
+    # dostaje płytką kopię słownika. Zamiana na JSON (build_snapshot) idzie w wątku.
+    captured = {}
+    for guild_id, state in guild_states.items():
+        mirror = state.snapshot_users
+        if mirror is None:
+            mirror = state.snapshot_users = {user_id: status.copy() for user_id, status in state.users.items()}
+        else:
+            for user_id in state.snapshot_stale:
+                status = state.users.get(user_id)
+                if status is not None:
+                    mirror[user_id] = status.copy()
+                else:
+                    mirror.pop(user_id, None)
+        state.snapshot_stale.clear()
+        captured[guild_id] = (dict(state.settings), dict(mirror))
+    return captured
+
+def build_snapshot(captured: dict = None) -> dict:
+    if captured is None:
+        captured = capture_snapshot()
+    to_save = {"settings": {}, "guilds": {}}
+    for guild_id, (settings, users) in captured.items():
+        users_json = {str(user_id): status.to_json() for user_id, status in users.items()}
+        to_save["guilds"][str(guild_id)] = {"settings": settings, "users": users_json}
+    return to_save
+
+class PersistenceService:
+    """
+    Zapis w tle. Zgłoszenia (save_data/compact_data) z okna PERSIST_COALESCE_WINDOW
+    dają jeden zapis. Na pętli robimy tylko to, co musi widzieć spójny stan
+    (kopia stanu, obrót dziennika), a fsync i serializację – w jednym wątku,
+    więc kolejne zapisy nigdy się nie wyprzedzają.
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persistence")
+        self.task = None              # Zadanie zapisu (czeka na okno albo pisze)
+        self.requested = False        # Było zgłoszenie od ostatniego przygotowania zapisu
+        self.compact_requested = False
+        self.requests = 0
+        self.writes = 0
+
+    def request(self, compact: bool = False):
+        self.requests += 1
+        self.requested = True
+        if compact:
+            self.compact_requested = True
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # Poza pętlą (skrypty, benchmarki) – zapis od razu
+            for job in self.prepare():
+                job()
+            return
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run(PERSIST_COALESCE_WINDOW))
+
+    def prepare(self) -> list:
+        global unsaved_changes
+        self.requested = False
+        unsaved_changes = False
+        jobs = [storage.flush_job(), usage_archive.flush_job()]
+        if self.compact_requested or storage.needs_compaction():
+            self.compact_requested = False
+            jobs.append(storage.compact_job(capture_snapshot()))
+        self.writes += 1
+        return [job for job in jobs if job is not None]
+
+    async def run(self, delay: float):
+        loop = asyncio.get_running_loop()
+        # Zgłoszenia w trakcie zapisu dają kolejny obieg zamiast zginąć
+        while self.requested:
+            if delay:
+                await asyncio.sleep(delay)
+            start = time.perf_counter()
+            jobs = self.prepare()
+            metrics.observe("persist_prepare_seconds", time.perf_counter() - start)
+            for job in jobs:
+                try:
+                    await loop.run_in_executor(self.executor, job)
+                except Exception as e:
+                    logging.error(f"Błąd zapisu danych w tle: {e}")
+            if delay and storage.needs_retry():
+                self.requested = True  # Paczka wycofana po błędzie – ponowienie po oknie
+            metrics.observe("save_data_seconds", time.perf_counter() - start)
+
+    async def flush(self):
+        # Zapis natychmiast (bez okna) i czekanie na jego koniec – np. przy shutdown
+        if self.task is not None and not self.task.done():
+            await self.task
+        self.requested = True
+        self.task = asyncio.create_task(self.run(0))
+        await self.task
+
+persistence = PersistenceService()
+metrics.counter_func("persistence_requests_total", lambda: persistence.requests)
+metrics.counter_func("persistence_writes_total", lambda: persistence.writes)
+
+def compact_data():
+    persistence.request(compact=True)
+
+def save_data():
+    # Zgłasza utrwalenie mutacji od ostatniego zapisu (fsync dziennika / commit
+    # bazy); pełny snapshot robimy tylko przy kompakcji.
+    # Jeśli od ostatniego zapisu nic się nie zmieniło – nic nie robimy.
+    if not unsaved_changes:
+        return
+    persistence.request()
+
+# ---------------------------------------------
+# MUTACJE STANU (każda trafia do dziennika)
+# ---------------------------------------------
+def apply_mutation(entry: dict):
+    op = entry.get("op")
+    # Wpisy sprzed podziału na gildie nie mają pola "guild".
+    guild_id = entry.get("guild", LEGACY_GUILD_ID)
+    if op == "adopt_legacy":
+        merge_legacy_state(guild_id)
+        return
+    state = get_guild_state(guild_id)
+    if op == "settings":
+        key = entry["key"]
+        if key in SETTINGS_KEYS:
+            state.settings[key] = entry["value"]
+            state.command_channels = None
+        return
+    if op == "drop_month":
+        for user_id, status in state.users.items():
+            if status.monthly_usage.pop(entry["month"], None) is not None:
+                state.snapshot_stale.add(user_id)
+        state.leaderboards.pop(entry["month"], None)
+        return
+    user_id = entry["user"]
+    state.snapshot_stale.add(user_id)
+    if op == "usage":
+        status = state.users.get(user_id)
+        if status is None:
+            status = UserStatus(entry.get("nick", ""))
+            state.users[user_id] = status
+        idx = SUBSTANCE_INDEX[entry["typ"]]
+        status.counts[idx] += entry["amount"]
+        stats = status.month_stats(entry["month"])
+        stats[idx] += entry["amount"]
+        get_leaderboard_index(state, entry["month"]).update(user_id, sum(stats))
+        expires = datetime.datetime.fromisoformat(entry["expires"]).timestamp()
+        status.expires[idx] = expires
+        schedule_expiry(guild_id, user_id, entry["typ"], expires)
+        return
+    status = state.users.get(user_id)
+    if status is None:
+        return
+    if op == "expire":
+        idx = SUBSTANCE_INDEX[entry["typ"]]
+        status.counts[idx] = 0
+        status.expires[idx] = 0.0
+    elif op == "clear":
+        for idx in range(len(SUBSTANCES)):
+            status.counts[idx] = 0
+            status.expires[idx] = 0.0
+    elif op == "nick":
+        status.original_nick = entry["value"]
+        state.leaderboard_pages.clear()
+
+def merge_legacy_state(guild_id: int):
+    # Przenosi stan LEGACY_GUILD_ID do gildii docelowej. Jeśli użytkownik jest
+    # w obu (dziennik sprzed migracji zapisywał już gildię), liczniki się sumują.
+    legacy = guild_states.pop(LEGACY_GUILD_ID, None)
+    if legacy is None or guild_id == LEGACY_GUILD_ID:
+        return
+    state = get_guild_state(guild_id)
+    for key, value in legacy.settings.items():
+        if state.settings.get(key) is None:
+            state.settings[key] = value
+    state.command_channels = None
+    for user_id, status in legacy.users.items():
+        current = state.users.get(user_id)
+        if current is None:
+            state.users[user_id] = status
+            continue
+        for idx in range(len(SUBSTANCES)):
+            current.counts[idx] += status.counts[idx]
+            current.expires[idx] = max(current.expires[idx], status.expires[idx])
+        for month, stats in status.monthly_usage.items():
+            current_stats = current.month_stats(month)
+            for idx, count in enumerate(stats):
+                current_stats[idx] += count
+    state.snapshot_users = None
+    rebuild_leaderboard_indexes(state)
+    rebuild_expiry_heap()
+
+def record_mutation(entry: dict):
+    global unsaved_changes
+    apply_mutation(entry)
+    storage.record(entry)
+    if event_log is not None:
+        event_log.record(entry)
+    unsaved_changes = True
+
+def set_setting(guild_id: int, key: str, value):
+    record_mutation({"op": "settings", "guild": guild_id, "key": key, "value": value})
+
+def add_usage(guild_id: int, user_id: int, original_nick: str, typ: str, amount: int):
+    now = clock.now()
+    expires = now + timedelta(hours=TIME_TO_EXPIRE[typ])
+    record_mutation({
+        "op": "usage",
+        "guild": guild_id,
+        "user": user_id,
+        "nick": original_nick,
+        "typ": typ,
+        "amount": amount,
+        "month": now.strftime("%Y-%m"),
+        "at": now.isoformat(),
+        "expires": expires.isoformat()
+    })
+    usage_archive.record(guild_id, user_id, typ, amount, now)
+    schedule_leaderboard_refresh(guild_id)
+
+def expire_substance(guild_id: int, user_id: int, typ: str):
+    record_mutation({"op": "expire", "guild": guild_id, "user": user_id, "typ": typ})
+
+def clear_usage(guild_id: int, user_id: int):
+    record_mutation({"op": "clear", "guild": guild_id, "user": user_id})
+
+def set_original_nick(guild_id: int, user_id: int, nick: str):
+    record_mutation({"op": "nick", "guild": guild_id, "user": user_id, "value": nick})
+
+def drop_month(guild_id: int, month: str):
+    record_mutation({"op": "drop_month", "guild": guild_id, "month": month})
+
+def adopt_legacy_state():
+    # Dane ze starego formatu (jedna gildia) przypisujemy gildii, w której jest
+    # któryś z zapisanych kanałów, a w razie braku – tej z największą liczbą ich użytkowników.
+    legacy = guild_states.get(LEGACY_GUILD_ID)
+    if legacy is None or not bot.guilds:
+        return
+    channel_ids = {
+        legacy.settings.get(key)
+        for key in ("dedicated_channel_id", "listening_channel_id", "live_leaderboard_channel_id")
+    } - {None}
+    target = None
+    for g in bot.guilds:
+        if any(g.get_channel(channel_id) for channel_id in channel_ids):
+            target = g
+            break
+    if target is None and SHARD_COUNT > 1:
+        # Inny proces może mieć gildię z tymi kanałami – nie zgadujemy po członkach
+        guild_states.pop(LEGACY_GUILD_ID, None)
+        return
+    if target is None:
+        target = max(bot.guilds, key=lambda g: sum(1 for user_id in legacy.users if g.get_member(user_id)))
+    record_mutation({"op": "adopt_legacy", "guild": target.id})
+    compact_data()
+    logging.info(f"Przypisano dane sprzed podziału na gildie do gildii {target.name} ({target.id}).")
+
+# ---------------------------------------------
+# PLANISTA WYGAŚNIĘĆ (kopiec + jeden timer)
+# ---------------------------------------------
+def schedule_expiry(guild_id: int, user_id: int, typ: str, ts: float):
+    if not expiry_heap or ts < expiry_heap[0][0]:
+        expiry_wakeup.set()
+    heapq.heappush(expiry_heap, (ts, guild_id, user_id, typ))
+
+def rebuild_expiry_heap():
+    expiry_heap.clear()
+    for guild_id, state in guild_states.items():
+        for user_id, status in state.users.items():
+            for typ, count, ts in zip(SUBSTANCES, status.counts, status.expires):
+                if ts and count > 0:
+                    expiry_heap.append((ts, guild_id, user_id, typ))
+    heapq.heapify(expiry_heap)
+    expiry_wakeup.set()
+
+def pop_due_expiries(now_ts: float) -> list:
+    # Zdejmuje wpisy, których termin minął. Wpis jest aktualny tylko wtedy,
+    # gdy zgadza się z bieżącym terminem w statusie (dodanie spożycia
+    # przesuwa termin i unieważnia starszy wpis w kopcu).
+    due = []
+    while expiry_heap and expiry_heap[0][0] <= now_ts:
+        ts, guild_id, user_id, typ = heapq.heappop(expiry_heap)
+        state = guild_states.get(guild_id)
+        status = state.users.get(user_id) if state else None
+        idx = SUBSTANCE_INDEX[typ]
+        if not status or status.counts[idx] <= 0 or status.expires[idx] != ts:
+            continue
+        due.append((guild_id, user_id, typ))
+    return due
+
+async def process_due_expiries():
+    due = pop_due_expiries(clock.time())
+    if not due:
+        return
+    expired_users = []
+    for guild_id, user_id, typ in due:
+        expire_substance(guild_id, user_id, typ)
+        if (guild_id, user_id) not in expired_users:
+            expired_users.append((guild_id, user_id))
+    for guild_id, user_id in expired_users:
+        status = guild_states[guild_id].users[user_id]
+        guild = bot.get_guild(guild_id)
+        found_member = guild.get_member(user_id) if guild else None
+        if not found_member:
+            continue
+        if status.is_idle():
+            current_nick = found_member.nick or found_member.name
+            pure_nick = remove_bot_suffix(current_nick)
+            if status.original_nick != pure_nick:
+                set_original_nick(guild_id, user_id, pure_nick)
+        await update_nickname(found_member, source="expire")
+    save_data()
+
+async def run_expiry_scheduler():
+    while True:
+        expiry_wakeup.clear()
+        if not expiry_heap:
+            await expiry_wakeup.wait()
+            continue
+        delay = expiry_heap[0][0] - clock.time()
+        if delay > 0:
+            try:
+                await asyncio.wait_for(expiry_wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        try:
+            await process_due_expiries()
+        except Exception as e:
+            logging.error(f"Błąd przetwarzania wygaśnięć: {e}")
+
+def start_expiry_scheduler():
+    global expiry_task
+    if expiry_task is None or expiry_task.done():
+        expiry_task = asyncio.create_task(run_expiry_scheduler())
+
+# ---------------------------------------------
+# INDEKS RANKINGU (aktualizowany przyrostowo)
+# ---------------------------------------------
+class BisectList:
+    """Minimalny zamiennik SortedList (add/remove/bisect/iteracja), gdy brak sortedcontainers."""
+
+    def __init__(self):
+        self.items = []
+
+    def add(self, item):
+        bisect.insort(self.items, item)
+
+    def remove(self, item):
+        idx = bisect.bisect_left(self.items, item)
+        if idx < len(self.items) and self.items[idx] == item:
+            del self.items[idx]
+        else:
+            raise ValueError(item)
+
+    def bisect_left(self, item) -> int:
+        return bisect.bisect_left(self.items, item)
+
+    def __getitem__(self, idx):
+        return self.items[idx]
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+class LeaderboardIndex:
+    """
+    Ranking jednego miesiąca: posortowane (-suma, user_id) + słownik sum.
+    Zmiana sumy użytkownika to O(log n); version rośnie przy każdej zmianie.
+    """
+
+    def __init__(self):
+        self.totals = {}
+        self.ranking = SortedList() if SortedList is not None else BisectList()
+        self.version = 0
+
+    def update(self, user_id: int, total: int):
+        old = self.totals.get(user_id)
+        if old == total:
+            return
+        if old is not None:
+            self.ranking.remove((-old, user_id))
+        if total > 0:
+            self.totals[user_id] = total
+            self.ranking.add((-total, user_id))
+        else:
+            self.totals.pop(user_id, None)
+        self.version += 1
+
+    def __iter__(self):
+        for neg_total, user_id in self.ranking:
+            yield user_id, -neg_total
+
+    def __len__(self):
+        return len(self.ranking)
+
+def get_leaderboard_index(state: GuildState, month: str) -> LeaderboardIndex:
+    index = state.leaderboards.get(month)
+    if index is None:
+        index = LeaderboardIndex()
+        state.leaderboards[month] = index
+    return index
+
+def rebuild_leaderboard_indexes(state: GuildState):
+    state.leaderboards.clear()
+    for user_id, status in state.users.items():
+        for month, stats in status.monthly_usage.items():
+            get_leaderboard_index(state, month).update(user_id, sum(stats))
+
+def iter_ranking(state: GuildState, month: str, guild: discord.Guild = None):
+    # Zwraca (user_id, stats, suma) w kolejności rankingu; z gildią – tylko jej obecnych członków.
+    # Generator – kto potrzebuje tylko czołówki, przerywa iterację wcześniej.
+    index = state.leaderboards.get(month)
+    if index is None:
+        return
+    for user_id, total in index:
+        if guild is not None and not guild.get_member(user_id):
+            continue
+        yield user_id, state.users[user_id].monthly_usage[month], total
+
+# ---------------------------------------------
+# INDEKS CZŁONKÓW (wyszukiwanie po nazwie / nicku)
+# ---------------------------------------------
+class MemberIndex:
+    """
+    Członkowie gildii po casefold(name) i casefold(nick bez sufiksu bota).
+    Dokładne trafienie to O(1), wyszukiwanie po prefiksie (autocomplete) to O(log n + k).
+    """
+
+    def __init__(self):
+        self.by_name = {}      # {klucz: set(member_id)}
+        self.by_nick = {}      # {klucz: set(member_id)}
+        self.member_keys = {}  # {member_id: (klucz nazwy, klucz nicku albo None)}
+        self.keys = SortedList() if SortedList is not None else BisectList()
+        self.key_refs = {}     # {klucz: liczba odwołań} – klucz jest w keys tylko raz
+
+    @staticmethod
+    def member_keys_for(member: discord.Member):
+        nick = remove_bot_suffix(member.nick) if member.nick else None
+        return member.name.casefold(), nick.casefold() if nick else None
+
+    def add_key(self, mapping: dict, key: str, member_id: int):
+        mapping.setdefault(key, set()).add(member_id)
+        refs = self.key_refs.get(key, 0)
+        if refs == 0:
+            self.keys.add(key)
+        self.key_refs[key] = refs + 1
+
+    def remove_key(self, mapping: dict, key: str, member_id: int):
+        ids = mapping.get(key)
+        if ids is None or member_id not in ids:
+            return
+        ids.discard(member_id)
+        if not ids:
+            del mapping[key]
+        refs = self.key_refs[key] - 1
+        if refs == 0:
+            del self.key_refs[key]
+            self.keys.remove(key)
+        else:
+            self.key_refs[key] = refs
+
+    def add(self, member: discord.Member):
+        self.remove(member.id)
+        name_key, nick_key = self.member_keys_for(member)
+        self.member_keys[member.id] = (name_key, nick_key)
+        self.add_key(self.by_name, name_key, member.id)
+        if nick_key:
+            self.add_key(self.by_nick, nick_key, member.id)
+
+    def remove(self, member_id: int):
+        keys = self.member_keys.pop(member_id, None)
+        if keys is None:
+            return
+        name_key, nick_key = keys
+        self.remove_key(self.by_name, name_key, member_id)
+        if nick_key:
+            self.remove_key(self.by_nick, nick_key, member_id)
+
+    def find(self, text: str):
+        # Najpierw nazwa użytkownika, potem nick – jak w dawnym przeszukiwaniu liniowym.
+        key = text.casefold()
+        ids = self.by_name.get(key) or self.by_nick.get(key)
+        return min(ids) if ids else None
+
+    def prefix(self, text: str, limit: int = 25) -> list:
+        prefix = text.casefold()
+        found = []
+        idx = self.keys.bisect_left(prefix)
+        while idx < len(self.keys) and len(found) < limit:
+            key = self.keys[idx]
+            if not key.startswith(prefix):
+                break
+            for member_id in sorted(self.by_name.get(key, set()) | self.by_nick.get(key, set())):
+                if member_id not in found:
+                    found.append(member_id)
+            idx += 1
+        return found[:limit]
+
+def get_member_index(guild: discord.Guild) -> MemberIndex:
+    state = get_guild_state(guild.id)
+    if state.member_index is None:
+        index = MemberIndex()
+        for member in guild.members:
+            index.add(member)
+        state.member_index = index
+    return state.member_index
+
+@bot.event
+async def on_member_join(member: discord.Member):
+    state = guild_states.get(member.guild.id)
+    if state:
+        state.leaderboard_pages.clear()  # Ranking pokazuje tylko obecnych członków
+    if state and state.member_index is not None:
+        state.member_index.add(member)
+
+@bot.event
+async def on_member_remove(member: discord.Member):
+    state = guild_states.get(member.guild.id)
+    if state:
+        state.leaderboard_pages.clear()
+    if state and state.member_index is not None:
+        state.member_index.remove(member.id)
 
-# ---------------------------------------------
-# MIGRACJA DANYCH (plik JSON)
-# ---------------------------------------------
-def migrate_raw_data(raw: dict) -> dict:
-    # Upewnij się, że w sekcji settings są wymagane klucze
-    settings = raw.get("settings", {})
-    if "listening_channel_id" not in settings:
-        settings["listening_channel_id"] = None
-    if "dedicated_channel_id" not in settings:
-        settings["dedicated_channel_id"] = None
-    if "live_leaderboard_message_id" not in settings:
-        settings["live_leaderboard_message_id"] = None
-    if "live_leaderboard_channel_id" not in settings:
-        settings["live_leaderboard_channel_id"] = None
-    raw["settings"] = settings
-    # Dla każdego wpisu użytkownika uzupełniamy brakujące klucze
-    for key, data in raw.items():
-        if key == "settings":
-            continue
-        if "original_nick" not in data:
-            data["original_nick"] = ""
-        for typ in VALID_TYPES:
-            if typ not in data:
-                data[typ] = 0
-        if "monthly_usage" not in data or not isinstance(data["monthly_usage"], dict):
-            data["monthly_usage"] = {}
-        if "expires_per_substance" not in data or not isinstance(data["expires_per_substance"], dict):
-            data["expires_per_substance"] = {}
-        for typ in VALID_TYPES:
-            if typ not in data["expires_per_substance"]:
-                data["expires_per_substance"][typ] = None
-    return raw
+@bot.event
+async def on_member_update(before: discord.Member, after: discord.Member):
+    if before.nick == after.nick and before.name == after.name:
+        return
+    state = guild_states.get(after.guild.id)
+    if state and state.member_index is not None:
+        state.member_index.add(after)
+
+@bot.event
+async def on_user_update(before: discord.User, after: discord.User):
+    # Zmiana nazwy konta nie wywołuje on_member_update – aktualizujemy gildie wspólne.
+    if before.name == after.name:
+        return
+    for guild in after.mutual_guilds:
+        state = guild_states.get(guild.id)
+        member = guild.get_member(after.id)
+        if state and state.member_index is not None and member:
+            state.member_index.add(member)
 
 # ---------------------------------------------
-# ŁADOWANIE / ZAPIS DANYCH
+# KOLEJKA ZMIAN NICKÓW
 # ---------------------------------------------
-def ensure_data_file_exists():
-    if not os.path.exists(DATA_FILE):
-        logging.info(f"Plik {DATA_FILE} nie istnieje. Tworzę go.")
-        base_data = {
-            "settings": {
-                "listening_channel_id": None,
-                "dedicated_channel_id": None,
-                "live_leaderboard_message_id": None,
-                "live_leaderboard_channel_id": None
-            }
-        }
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(base_data, f, ensure_ascii=False, indent=2)
+class NicknameQueue:
+    """
+    Centralna kolejka edycji nicków. Kilka zleceń dla tego samego członka
+    scala się w ostatnie, edycje bez zmiany są pomijane, a w obrębie jednej
+    gildii (wspólny bucket rate limitu) edycje idą co NICK_EDIT_INTERVAL.
+    Każda gildia ma własną podkolejkę; workery biorą gildie z listy gotowych
+    po kolei (jedna edycja na turę), więc duża gildia nie blokuje pozostałych.
+    """
 
-def load_data():
-    global user_statuses, listening_channel_id, dedicated_channel_id
-    global live_leaderboard_message_id, live_leaderboard_channel_id
-    ensure_data_file_exists()
-    try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            raw = json.load(f)
-    except (json.JSONDecodeError, OSError) as e:
-        logging.error(f"Błąd wczytywania {DATA_FILE}: {e}")
-        raw = {"settings": {"listening_channel_id": None}}
-    raw = migrate_raw_data(raw)
-    settings = raw.get("settings", {})
-    listening_channel_id = settings.get("listening_channel_id", None)
-    dedicated_channel_id = settings.get("dedicated_channel_id", None)
-    live_leaderboard_message_id = settings.get("live_leaderboard_message_id")
-    live_leaderboard_channel_id = settings.get("live_leaderboard_channel_id")
-    temp_statuses = {}
-    for user_id_str, data in raw.items():
-        if user_id_str == "settings":
-            continue
-        try:
-            user_id = int(user_id_str)
-        except ValueError:
-            continue
-        eps = data.get("expires_per_substance", {})
-        for typ, val in eps.items():
-            if val is not None:
-                try:
-                    eps[typ] = datetime.datetime.fromisoformat(val)
-                except ValueError:
-                    eps[typ] = None
-        data["expires_per_substance"] = eps
-        temp_statuses[user_id] = data
-    user_statuses.clear()
-    user_statuses.update(temp_statuses)
-    logging.info("Dane zostały wczytane z pliku.")
+    def __init__(self):
+        self.pending = {}       # {(guild_id, member_id): (member, nick, source, enqueued_at)}
+        self.guild_queues = {}  # {guild_id: deque kluczy z pending}
+        self.ready = asyncio.Queue()  # Gildie gotowe do obsługi (round-robin)
+        self.scheduled = set()  # Gildie w ready, czekające na termin albo właśnie obsługiwane
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.guild_next = {}    # {guild_id: najwcześniejszy czas kolejnej edycji (monotonic)}
+        self.workers = []
+        self.active = 0         # Zlecenia właśnie przetwarzane przez workery
+        self.reported = 0       # Liczba edycji przy ostatnim raporcie w logu
+        self.submitted = 0
+        self.coalesced = 0
+        self.skipped = 0
+        self.edited = 0
+        self.failed = 0
+        self.retried = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
 
-def save_data():
-    to_save = {"settings": {}}
-    to_save["settings"]["listening_channel_id"] = listening_channel_id
-    to_save["settings"]["dedicated_channel_id"] = dedicated_channel_id
-    to_save["settings"]["live_leaderboard_message_id"] = live_leaderboard_message_id
-    to_save["settings"]["live_leaderboard_channel_id"] = live_leaderboard_channel_id
-    for user_id, data in user_statuses.items():
-        data_copy = dict(data)
-        if "expires_per_substance" in data_copy:
-            eps_dict = {}
-            for typ, dt_value in data_copy["expires_per_substance"].items():
-                if isinstance(dt_value, datetime.datetime):
-                    eps_dict[typ] = dt_value.isoformat()
+    def submit(self, member: discord.Member, nick: str, source: str = "command"):
+        key = (member.guild.id, member.id)
+        self.submitted += 1
+        if key in self.pending:
+            enqueued_at = self.pending[key][3]
+            self.pending[key] = (member, nick, source, enqueued_at)
+            self.coalesced += 1
+            metrics.inc("nickname_edits_avoided_total", reason="coalesced")
+            return
+        if nick == (member.nick or member.name):
+            self.skipped += 1
+            metrics.inc("nickname_edits_avoided_total", reason="unchanged")
+            return
+        self.pending[key] = (member, nick, source, time.monotonic())
+        self.guild_queues.setdefault(key[0], deque()).append(key)
+        self.idle.clear()
+        self.schedule(key[0])
+
+    def schedule(self, guild_id: int):
+        # Gildia jest w obiegu najwyżej raz; przed terminem z rate limitu wraca z opóźnieniem
+        if guild_id in self.scheduled:
+            return
+        self.scheduled.add(guild_id)
+        delay = self.guild_next.get(guild_id, 0) - time.monotonic()
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self.ready.put_nowait, guild_id)
+        else:
+            self.ready.put_nowait(guild_id)
+
+    def start(self):
+        self.workers = [w for w in self.workers if not w.done()]
+        while len(self.workers) < NICK_QUEUE_WORKERS:
+            self.workers.append(asyncio.create_task(self.worker()))
+
+    def stop(self):
+        for w in self.workers:
+            w.cancel()
+        self.workers = []
+
+    def retarget(self, target, source: str):
+        # Podmienia cel wszystkich oczekujących edycji (zamknięcie: przywrócenie nicku)
+        for key, (member, nick, _, enqueued_at) in self.pending.items():
+            self.pending[key] = (member, target(member), source, enqueued_at)
+
+    async def join(self):
+        await self.idle.wait()
+
+    async def worker(self):
+        while True:
+            guild_id = await self.ready.get()
+            queue = self.guild_queues.get(guild_id)
+            self.active += 1
+            try:
+                if queue:
+                    await self.process(queue.popleft())
+            except Exception as e:
+                logging.error(f"Błąd kolejki nicków: {e}")
+            finally:
+                self.active -= 1
+                self.scheduled.discard(guild_id)
+                if self.guild_queues.get(guild_id):
+                    self.schedule(guild_id)  # Na koniec listy gotowych – kolej innych gildii
                 else:
-                    eps_dict[typ] = None
-            data_copy["expires_per_substance"] = eps_dict
-        to_save[str(user_id)] = data_copy
-    try:
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(to_save, f, ensure_ascii=False, indent=2)
-        logging.info(f"Dane zapisano do {DATA_FILE}.")
-    except OSError as e:
-        logging.error(f"Błąd zapisu do {DATA_FILE}: {e}")
+                    self.guild_queues.pop(guild_id, None)
+            if not self.scheduled and not self.active:
+                self.idle.set()
+                if self.edited != self.reported:
+                    self.reported = self.edited
+                    stats = self.stats()
+                    logging.info(
+                        f"Kolejka nicków opróżniona: {stats['edited']} edycji, "
+                        f"średnie opóźnienie {stats['latency_avg']:.2f}s, maks. {stats['latency_max']:.2f}s."
+                    )
+
+    async def process(self, key):
+        guild_id = key[0]
+        # Bierzemy najnowsze zlecenie (submit mogło je nadpisać w kolejce).
+        item = self.pending.pop(key, None)
+        if item is None:
+            return
+        member, nick, source, enqueued_at = item
+        if nick == (member.nick or member.name):
+            self.skipped += 1
+            metrics.inc("nickname_edits_avoided_total", reason="unchanged")
+            return
+        try:
+            if await apply_nickname(member, nick, source):
+                self.edited += 1
+            else:
+                self.failed += 1
+        except discord.HTTPException as e:
+            if e.status == 429:
+                # Rate limit: gildia czeka retry_after, a zlecenie wraca do kolejki
+                # (chyba że w międzyczasie przyszło nowsze – ono już w niej jest).
+                retry_after = getattr(e, "retry_after", None) or NICK_EDIT_INTERVAL * 5
+                self.guild_next[guild_id] = time.monotonic() + retry_after
+                self.retried += 1
+                metrics.inc("nickname_edit_retries_total")
+                if key not in self.pending:
+                    self.pending[key] = item
+                    self.guild_queues.setdefault(guild_id, deque()).append(key)
+                return
+            self.failed += 1
+            logging.warning(f"Nie udało się zmienić nicku {member.name}: {e}")
+        latency = time.monotonic() - enqueued_at
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        self.guild_next[guild_id] = time.monotonic() + NICK_EDIT_INTERVAL
+
+    def stats(self) -> dict:
+        return {
+            "depth": len(self.pending),
+            "submitted": self.submitted,
+            "coalesced": self.coalesced,
+            "skipped": self.skipped,
+            "edited": self.edited,
+            "failed": self.failed,
+            "retried": self.retried,
+            "latency_avg": self.latency_total / self.edited if self.edited else 0.0,
+            "latency_max": self.latency_max
+        }
+
+nickname_queue = NicknameQueue()
+metrics.gauge("nickname_queue_depth", lambda: len(nickname_queue.pending))
+metrics.counter_func("nickname_queue_edited_total", lambda: nickname_queue.edited)
+metrics.counter_func("nickname_queue_failed_total", lambda: nickname_queue.failed)
+metrics.counter_func("nick_render_cache_hits_total", lambda: render_nick.cache_info().hits)
+metrics.gauge("reaction_queue_depth", lambda: reaction_queue.qsize())
+metrics.gauge("expiry_heap_size", lambda: len(expiry_heap))
+metrics.gauge("guilds", lambda: len(guild_states))
 
 # ---------------------------------------------
 # FUNKCJE POMOCNICZE
 # ---------------------------------------------
-def create_new_status(original_nick: str) -> dict:
-    return {
-        "original_nick": original_nick,
-        "piwo": 0,
-        "wodka": 0,
-        "whiskey": 0,
-        "wino": 0,
-        "drink": 0,
-        "blunt": 0,
-        "monthly_usage": {},
-        "expires_per_substance": {typ: None for typ in VALID_TYPES}
-    }
-
 def remove_bot_suffix(nick: str) -> str:
     if not nick:
         return nick
@@ -196,36 +2270,39 @@ def remove_bot_suffix(nick: str) -> str:
     return nick
 
 def get_current_month() -> str:
-    return datetime.datetime.now(timezone.utc).strftime("%Y-%m")
-
-def ensure_monthly_record(data: dict, month: str):
-    if "monthly_usage" not in data:
-        data["monthly_usage"] = {}
-    if month not in data["monthly_usage"]:
-        data["monthly_usage"][month] = {typ: 0 for typ in VALID_TYPES}
-
-def build_usage_string(status_data: dict) -> str:
-    parts = []
-    for typ in VALID_TYPES:
-        count = status_data.get(typ, 0)
-        if count > 0:
-            parts.append(f"{TYPE_TO_EMOJI[typ]}{count}")
-    return "".join(parts)
+    return clock.now().strftime("%Y-%m")
 
-async def update_nickname(member: discord.Member, source="command"):
-    data = user_statuses.get(member.id)
-    if not data:
-        return
-    pure_original = remove_bot_suffix(data.get("original_nick") or (member.nick or member.name))
-    data["original_nick"] = pure_original
-    usage_str = build_usage_string(data)
-    new_nick = f"{pure_original}{NBSP}{usage_str}" if usage_str else pure_original
+@functools.lru_cache(maxsize=NICK_RENDER_CACHE_SIZE)
+def render_nick(original_nick: str, counts: tuple) -> str:
+    # Ten sam nick i liczniki dają zawsze ten sam wynik (kolejność z SUBSTANCES)
+    usage_str = "".join(f"{TYPE_TO_EMOJI[typ]}{count}" for typ, count in zip(SUBSTANCES, counts) if count > 0)
+    new_nick = f"{original_nick}{NBSP}{usage_str}" if usage_str else original_nick
     if len(new_nick) > 32:
         new_nick = new_nick[:31] + "…"
+    return new_nick
+
+async def update_nickname(member: discord.Member, source="command"):
+    if shutting_down:
+        return  # Zamknięcie przywraca nicki – nowych sufiksów już nie dodajemy
+    state = guild_states.get(member.guild.id)
+    status = state.users.get(member.id) if state else None
+    if not status:
+        return
+    pure_original = remove_bot_suffix(status.original_nick or (member.nick or member.name))
+    if status.original_nick != pure_original:
+        set_original_nick(member.guild.id, member.id, pure_original)
+    nickname_queue.submit(member, render_nick(pure_original, tuple(status.counts)), source)
+
+@timed("apply_nickname")
+async def apply_nickname(member: discord.Member, new_nick: str, source: str) -> bool:
+    # Właściwe wywołanie API (z workera NicknameQueue) – update_nickname tylko kolejkuje
     try:
         await member.edit(nick=new_nick)
+        return True
     except discord.Forbidden:
-        if member.guild.owner_id == member.id:
+        if source == "startup":
+            return False
+        if member.guild.owner_id == member.id and source in ("command", "expire"):
             try:
                 if source == "command":
                     await member.send(
@@ -241,6 +2318,7 @@ async def update_nickname(member: discord.Member, source="command"):
                 logging.warning(f"Nie udało się wysłać DM do właściciela ({member.name}).")
         else:
             logging.warning(f"Brak uprawnień do zmiany nicku {member.name}.")
+        return False
 
 def find_user_in_guild(guild: discord.Guild, name_or_mention: str) -> discord.Member:
     if not guild:
@@ -254,13 +2332,18 @@ def find_user_in_guild(guild: discord.Guild, name_or_mention: str) -> discord.Me
         mention_id = int(name_or_mention)
     if mention_id is not None:
         return guild.get_member(mention_id)
-    name_lower = name_or_mention.lower()
-    for member in guild.members:
-        if member.name.lower() == name_lower:
-            return member
-        if member.nick and member.nick.lower() == name_lower:
-            return member
-    return None
+    member_id = get_member_index(guild).find(name_or_mention)
+    return guild.get_member(member_id) if member_id is not None else None
+
+async def member_autocomplete(interaction: discord.Interaction, current: str) -> list:
+    if not interaction.guild:
+        return []
+    choices = []
+    for member_id in get_member_index(interaction.guild).prefix(current):
+        member = interaction.guild.get_member(member_id)
+        if member:
+            choices.append(app_commands.Choice(name=member.display_name[:100], value=str(member.id)))
+    return choices
 
 def can_add_for_others(member: discord.Member) -> bool:
     return member.guild_permissions.administrator or member.guild_permissions.manage_nicknames
@@ -268,253 +2351,700 @@ def can_add_for_others(member: discord.Member) -> bool:
 def can_clear_others(member: discord.Member) -> bool:
     return member.guild_permissions.administrator or member.guild_permissions.manage_nicknames
 
-def build_leaderboard_text(guild: discord.Guild) -> str:
-    current_month = get_current_month()
-    usage_list = []
-    for user_id, data in user_statuses.items():
-        if not guild.get_member(user_id):
-            continue
-        monthly = data.get("monthly_usage", {})
-        stats = monthly.get(current_month, {})
-        total_used = sum(stats.values())
-        if total_used > 0:
-            usage_list.append((user_id, stats, total_used))
-    usage_list.sort(key=lambda x: x[2], reverse=True)
-    if not usage_list:
-        return f"Nikt nie ma punktów w miesiącu {current_month}."
-    lines = []
-    pos = 1
-    for user_id, stats, total_used in usage_list:
-        data = user_statuses[user_id]
-        original_nick = remove_bot_suffix(data.get("original_nick") or "")
-        if not original_nick:
-            member = guild.get_member(user_id)
-            original_nick = member.display_name if member else f"<@{user_id}>"
-        detail_parts = []
-        for t in VALID_TYPES:
-            val = stats.get(t, 0)
-            if val > 0:
-                detail_parts.append(f"{TYPE_TO_EMOJI[t]}{val}")
-        detail_str = "".join(detail_parts) or "Brak"
-        lines.append(f"**{pos})** {original_nick} ({detail_str}) - Suma: {total_used}")
-        pos += 1
-    return f"**Tabela wyników za {current_month}**:\n" + "\n".join(lines)
-
-def build_leaderboard_embed(guild: discord.Guild) -> discord.Embed:
-    current_month = get_current_month()
-    usage_list = []
-    for user_id, data in user_statuses.items():
-        if not guild.get_member(user_id):
-            continue
-        monthly = data.get("monthly_usage", {})
-        stats = monthly.get(current_month, {})
-        total_used = sum(stats.values())
-        if total_used > 0:
-            usage_list.append((user_id, stats, total_used))
-    usage_list.sort(key=lambda x: x[2], reverse=True)
+def display_nick(state: GuildState, user_id: int, guild: discord.Guild = None) -> str:
+    original_nick = remove_bot_suffix(state.users[user_id].original_nick or "")
+    if not original_nick:
+        member = guild.get_member(user_id) if guild else None
+        original_nick = member.display_name if member else f"<@{user_id}>"
+    return original_nick
+
+def build_detail_string(stats: array) -> str:
+    detail_parts = []
+    for t, val in zip(SUBSTANCES, stats):
+        if val > 0:
+            detail_parts.append(f"{TYPE_TO_EMOJI[t]}{val}")
+    return "".join(detail_parts) or "Brak"
+
+class PageSplitter:
+    """
+    Podział pozycji na strony: maks. LEADERBOARD_PAGE_SIZE pozycji i maks.
+    `budget` znaków. Pozycje dochodzą po jednej, strona zamyka się, gdy
+    kolejna już się nie mieści.
+    """
+    __slots__ = ("size_of", "budget", "pages", "page", "chars")
+
+    def __init__(self, size_of, budget: int):
+        self.size_of = size_of
+        self.budget = budget
+        self.pages = []  # Zamknięte strony
+        self.page = []   # Strona w budowie
+        self.chars = 0
+
+    def add(self, item):
+        size = self.size_of(item)
+        if self.page and (len(self.page) >= LEADERBOARD_PAGE_SIZE or self.chars + size > self.budget):
+            self.pages.append(self.page)
+            self.page, self.chars = [], 0
+        self.page.append(item)
+        self.chars += size
+
+    def finish(self):
+        if self.page:
+            self.pages.append(self.page)
+            self.page, self.chars = [], 0
+
+class LeaderboardPages:
+    """
+    Ranking jednego miesiąca podzielony na strony w limitach Discorda.
+    Strony renderujemy leniwie – tylko do tej, o którą ktoś pyta – więc
+    żywy leaderboard płaci za pierwszą stronę, nie za cały miesiąc. Ważny,
+    dopóki indeks i jego version się nie zmienią.
+    """
+    __slots__ = ("month", "index", "version", "state", "guild", "ranking", "complete", "fields", "texts")
+
+    def __init__(self, state: GuildState, guild: discord.Guild, month: str):
+        self.month = month
+        self.index = state.leaderboards.get(month)
+        self.version = self.index.version if self.index is not None else -1
+        self.state = state
+        self.guild = guild
+        self.ranking = enumerate(iter_ranking(state, month, guild), start=1)
+        self.complete = False  # Cały ranking wyrenderowany – znamy liczbę stron
+        self.fields = PageSplitter(lambda f: len(f[0]) + len(f[1]), EMBED_PAGE_CHAR_BUDGET)
+        self.texts = PageSplitter(lambda line: len(line) + 1, TEXT_PAGE_CHAR_BUDGET)
+
+    def render_until(self, pages: PageSplitter, page: int):
+        while not self.complete and len(pages.pages) <= page:
+            item = next(self.ranking, None)
+            if item is None:
+                self.complete = True
+                self.fields.finish()
+                self.texts.finish()
+                return
+            pos, (user_id, stats, total_used) = item
+            original_nick = display_nick(self.state, user_id, self.guild)
+            detail_str = build_detail_string(stats)
+            self.fields.add((f"{pos}) {original_nick}"[:256], f"{detail_str} | Suma: {total_used}"[:1024]))
+            self.texts.add(f"**{pos})** {original_nick} ({detail_str}) - Suma: {total_used}"[:TEXT_PAGE_CHAR_BUDGET])
+
+    def get(self, pages: PageSplitter, page: int) -> tuple:
+        # (numer strony przycięty do zakresu, pozycje strony); pusty ranking – (0, [])
+        self.render_until(pages, page)
+        page = max(0, min(page, len(pages.pages) - 1))
+        return page, pages.pages[page] if pages.pages else []
+
+    def has_page(self, pages: PageSplitter, page: int) -> bool:
+        self.render_until(pages, page)
+        return page < len(pages.pages)
+
+    def label(self, pages: PageSplitter, page: int) -> str:
+        # Liczbę stron podajemy, dopiero gdy ranking jest wyrenderowany do końca
+        return f"{page + 1}/{len(pages.pages)}" if self.complete else f"{page + 1}"
+
+def get_leaderboard_pages(guild: discord.Guild, month: str = None) -> LeaderboardPages:
+    # Cache kluczowany (gildia, miesiąc, version) – kolejne strony dorenderowują się z tego samego przejścia
+    month = month or get_current_month()
+    state = get_guild_state(guild.id)
+    index = state.leaderboards.get(month)
+    version = index.version if index is not None else -1
+    pages = state.leaderboard_pages.get(month)
+    if pages is not None and pages.index is index and pages.version == version:
+        metrics.inc("leaderboard_cache_total", result="hit")
+        return pages
+    metrics.inc("leaderboard_cache_total", result="miss")
+    pages = LeaderboardPages(state, guild, month)
+    state.leaderboard_pages[month] = pages
+    return pages
+
+def build_leaderboard_text(guild: discord.Guild, page: int = 0) -> str:
+    pages = get_leaderboard_pages(guild)
+    page, lines = pages.get(pages.texts, page)
+    if not lines:
+        return f"Nikt nie ma punktów w miesiącu {pages.month}."
+    header = f"**Tabela wyników za {pages.month}**"
+    if page > 0 or pages.has_page(pages.texts, 1):
+        header += f" (strona {pages.label(pages.texts, page)})"
+    return f"{header}:\n" + "\n".join(lines)
+
+@timed("build_leaderboard_embed")
+def build_leaderboard_embed(guild: discord.Guild, page: int = 0) -> discord.Embed:
+    pages = get_leaderboard_pages(guild)
     embed = discord.Embed(
         title="Aktualizowany Leaderboard",
-        description=f"Wyniki miesiąca: {current_month}",
+        description=f"Wyniki miesiąca: {pages.month}",
         color=discord.Color.blue()
     )
-    if not usage_list:
+    page, fields = pages.get(pages.fields, page)
+    if not fields:
         embed.add_field(name="Brak danych", value="Nikt nie ma punktów w tym miesiącu", inline=False)
         return embed
-    pos = 1
-    for user_id, stats, total_used in usage_list:
-        data = user_statuses[user_id]
-        original_nick = remove_bot_suffix(data.get("original_nick") or "")
-        if not original_nick:
-            member = guild.get_member(user_id)
-            original_nick = member.display_name if member else f"<@{user_id}>"
-        detail_parts = []
-        for t in VALID_TYPES:
-            val = stats.get(t, 0)
-            if val > 0:
-                detail_parts.append(f"{TYPE_TO_EMOJI[t]}{val}")
-        detail_str = "".join(detail_parts) or "Brak"
-        embed.add_field(
-            name=f"{pos}) {original_nick}",
-            value=f"{detail_str} | Suma: {total_used}",
-            inline=False
-        )
-        pos += 1
+    for name, value in fields:
+        embed.add_field(name=name, value=value, inline=False)
+    if page > 0 or pages.has_page(pages.fields, 1):
+        embed.set_footer(text=f"Strona {pages.label(pages.fields, page)} • pełny ranking: /leaderboard")
     return embed
 
+class LeaderboardView(discord.ui.View):
+    # Przyciski stron – każde kliknięcie bierze gotową stronę z cache
+    def __init__(self, guild: discord.Guild, text: bool = False):
+        super().__init__(timeout=LEADERBOARD_VIEW_TIMEOUT)
+        self.guild = guild
+        self.text = text
+        self.page = 0
+        self.update_buttons()
+
+    def update_buttons(self):
+        pages = get_leaderboard_pages(self.guild)
+        split = pages.texts if self.text else pages.fields
+        self.page = pages.get(split, self.page)[0]
+        self.previous_page.disabled = self.page == 0
+        self.next_page.disabled = not pages.has_page(split, self.page + 1)
+
+    def render(self) -> dict:
+        if self.text:
+            return {"content": build_leaderboard_text(self.guild, self.page)}
+        return {"embed": build_leaderboard_embed(self.guild, self.page)}
+
+    async def turn(self, interaction: discord.Interaction, delta: int):
+        self.page += delta
+        self.update_buttons()
+        await interaction.response.edit_message(**self.render(), view=self)
+
+    @discord.ui.button(label="◀", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.turn(interaction, -1)
+
+    @discord.ui.button(label="▶", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.turn(interaction, 1)
+
+def build_archive_text(guild: discord.Guild, user: discord.Member = None, year: int = None) -> str:
+    scope = f"w roku {year}" if year else "w całej historii"
+    year_key = str(year) if year else None
+    if user is not None:
+        totals = usage_archive.user_totals(guild.id, user.id, year_key)
+        if not any(totals):
+            return f"{user.display_name} nie ma wpisów w archiwum {scope}."
+        return f"**{user.display_name} {scope}**: {build_detail_string(totals)} - Suma: {sum(totals)}"
+    lines = []
+    for pos, (user_id, stats, total_used) in enumerate(usage_archive.leaderboard(guild.id, year_key), start=1):
+        member = guild.get_member(user_id)
+        original_nick = member.display_name if member else f"<@{user_id}>"
+        lines.append(f"**{pos})** {original_nick} ({build_detail_string(stats)}) - Suma: {total_used}")
+    if not lines:
+        return f"Archiwum nie ma zamkniętych miesięcy {scope}."
+    return f"**Ranking z archiwum {scope}**:\n" + "\n".join(lines)
+
 # ---------------------------------------------
 # TASK: update_live_leaderboard
 # ---------------------------------------------
+def embed_digest(embed: discord.Embed) -> str:
+    payload = json.dumps(embed.to_dict(), sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+async def refresh_live_leaderboard(state: GuildState):
+    # Edytujemy wiadomość tylko, gdy wyrenderowany embed się zmienił.
+    # PartialMessage pozwala edytować bez wcześniejszego fetch_message.
+    channel_id = state.settings["live_leaderboard_channel_id"]
+    message_id = state.settings["live_leaderboard_message_id"]
+    if not channel_id or not message_id:
+        return
+    guild = bot.get_guild(state.guild_id)
+    channel = guild.get_channel(channel_id) if guild else None
+    if not channel:
+        return
+    embed = build_leaderboard_embed(guild)
+    digest = (channel.id, message_id, embed_digest(embed))
+    if state.live_leaderboard_digest == digest:
+        return
+    msg = channel.get_partial_message(message_id)
+    try:
+        await msg.edit(embed=embed)
+    except discord.HTTPException:
+        return
+    state.live_leaderboard_digest = digest
+
+async def debounced_leaderboard_refresh():
+    global leaderboard_refresh_task
+    await asyncio.sleep(LEADERBOARD_DEBOUNCE_SECONDS)
+    leaderboard_refresh_task = None
+    guild_ids = list(pending_leaderboard_guilds)
+    pending_leaderboard_guilds.clear()
+    for guild_id in guild_ids:
+        state = guild_states.get(guild_id)
+        if state:
+            await refresh_live_leaderboard(state)
+
+def schedule_leaderboard_refresh(guild_id: int):
+    # Wiele zmian w krótkim czasie (np. seria reakcji) → jedna edycja na gildię.
+    global leaderboard_refresh_task
+    pending_leaderboard_guilds.add(guild_id)
+    if leaderboard_refresh_task is not None and not leaderboard_refresh_task.done():
+        return
+    try:
+        leaderboard_refresh_task = asyncio.get_running_loop().create_task(debounced_leaderboard_refresh())
+    except RuntimeError:
+        # Brak pętli zdarzeń (np. wczytywanie danych poza botem) – odświeży zadanie minutowe.
+        leaderboard_refresh_task = None
+
 @tasks.loop(minutes=1)
 async def update_live_leaderboard():
-    if not live_leaderboard_channel_id or not live_leaderboard_message_id:
-        return
-    for g in bot.guilds:
-        channel = g.get_channel(live_leaderboard_channel_id)
-        if channel:
-            try:
-                msg = await channel.fetch_message(live_leaderboard_message_id)
-            except discord.NotFound:
-                continue
-            embed = build_leaderboard_embed(g)
-            try:
-                await msg.edit(embed=embed)
-            except discord.HTTPException:
-                pass
+    metrics.task_tick("update_live_leaderboard", 60)
+    # guild_states trzyma tylko gildie własnych shardów (owns_guild) – dzierżawa zbędna
+    for state in list(guild_states.values()):
+        await refresh_live_leaderboard(state)
 
 # ---------------------------------------------
-# TASK: export_monthly_stats
+# TASK: export_monthly_stats – zamknięcie miesiąca (z nadrabianiem)
 # ---------------------------------------------
-@tasks.loop(minutes=1)
+def write_month_export(folder: str, guild_id: int, month: str, ranking: list) -> list:
+    # Działa w wątku: ranking to gotowe (user_id, nick, liczniki, suma) skopiowane w pętli.
+    os.makedirs(folder, exist_ok=True)
+    text_lines = []
+    json_rows = []
+    csv_buffer = io.StringIO()
+    writer = csv.writer(csv_buffer)
+    writer.writerow(["pozycja", "user_id", "nick", *SUBSTANCES, "suma"])
+    for pos, (user_id, nick, stats, total_used) in enumerate(ranking, start=1):
+        text_lines.append(f"{nick} | {build_detail_string(stats)} | Suma: {total_used}")
+        writer.writerow([pos, user_id, nick, *stats, total_used])
+        json_rows.append({
+            "pozycja": pos,
+            "user_id": user_id,
+            "nick": nick,
+            **dict(zip(SUBSTANCES, stats)),
+            "suma": total_used
+        })
+    payload = {"guild_id": guild_id, "month": month, "ranking": json_rows}
+    outputs = {
+        "txt": "\n".join(text_lines),
+        "csv": csv_buffer.getvalue(),
+        "json": json.dumps(payload, ensure_ascii=False, indent=2)
+    }
+    paths = []
+    for ext, content in outputs.items():
+        path = os.path.join(folder, f"{month}.{ext}")
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        paths.append(path)
+    return paths
+
+def months_to_export(state: GuildState, current_month: str) -> list:
+    # Wszystkie zakończone miesiące, które wciąż są w pamięci – także te
+    # przegapione, gdy bot był wyłączony na przełomie miesiąca.
+    return sorted(month for month in state.leaderboards if month < current_month)
+
+async def export_month(state: GuildState, month: str):
+    guild_id = state.guild_id
+    loop = asyncio.get_running_loop()
+    last_exported = state.settings.get("last_exported_month")
+    # Miesiąc zapisany wcześniej, ale niezdjęty z pamięci (np. restart w trakcie)
+    # – pliki już są, wystarczy dokończyć drop_month.
+    if last_exported is None or month > last_exported:
+        guild = bot.get_guild(guild_id)
+        ranking = [
+            (user_id, display_nick(state, user_id, guild), list(stats), total_used)
+            for user_id, stats, total_used in iter_ranking(state, month)
+        ]
+        usage = {
+            user_id: array("i", status.monthly_usage[month])
+            for user_id, status in state.users.items()
+            if month in status.monthly_usage
+        }
+        # Pliki .events zapisuje, czyta i usuwa tylko wątek persistence – flush
+        # dopisuje zdarzenia z bufora, a close_month czyta je już po nim.
+        await persistence.flush()
+        usage_archive.evict(guild_id, month)
+        folder = os.path.join(STATS_FOLDER, str(guild_id))
+        paths = await loop.run_in_executor(None, write_month_export, folder, guild_id, month, ranking)
+        logging.info(f"Wyeksportowano statystyki za {month} do {', '.join(paths)}.")
+        archive_path = await loop.run_in_executor(
+            persistence.executor, usage_archive.close_month, guild_id, month, usage
+        )
+        logging.info(f"Zarchiwizowano spożycie za {month} w {archive_path}.")
+        set_setting(guild_id, "last_exported_month", month)
+    drop_month(guild_id, month)
+    save_data()
+    await persistence.flush()  # Zdarzenia usuwamy dopiero, gdy drop_month jest na dysku
+    await loop.run_in_executor(persistence.executor, usage_archive.discard_events, guild_id, month)
+
+@tasks.loop(hours=1)
 async def export_monthly_stats():
-    now = datetime.datetime.now(timezone.utc)
-    current_month = now.strftime("%Y-%m")
-    if now.day == 1:
-        prev_month_date = now - timedelta(days=1)
-        prev_month = prev_month_date.strftime("%Y-%m")
-        if not os.path.exists(STATS_FOLDER):
-            os.makedirs(STATS_FOLDER)
-        lines = []
-        for user_id, data in user_statuses.items():
-            monthly = data.get("monthly_usage", {})
-            stats = monthly.get(prev_month, {})
-            total_used = sum(stats.values())
-            if total_used > 0:
-                original_nick = remove_bot_suffix(data.get("original_nick") or "")
-                if not original_nick:
-                    member = None
-                    for g in bot.guilds:
-                        member = g.get_member(user_id)
-                        if member:
-                            break
-                    original_nick = member.display_name if member else f"<@{user_id}>"
-                detail_parts = []
-                for t in VALID_TYPES:
-                    val = stats.get(t, 0)
-                    if val > 0:
-                        detail_parts.append(f"{TYPE_TO_EMOJI[t]}{val}")
-                detail_str = "".join(detail_parts) or "Brak"
-                lines.append(f"{original_nick} | {detail_str} | Suma: {total_used}")
-        export_text = "\n".join(lines)
-        file_path = os.path.join(STATS_FOLDER, f"{prev_month}.txt")
-        with open(file_path, "w", encoding="utf-8") as f:
-            f.write(export_text)
-        logging.info(f"Wyeksportowano statystyki za {prev_month} do {file_path}.")
-        for data in user_statuses.values():
-            monthly = data.get("monthly_usage", {})
-            if prev_month in monthly:
-                del monthly[prev_month]
-        save_data()
+    # Pierwszy przebieg (zaraz po starcie) nadrabia miesiące z czasu przestoju.
+    current_month = get_current_month()
+    for state in list(guild_states.values()):
+        if state.guild_id == LEGACY_GUILD_ID:
+            continue
+        months = months_to_export(state, current_month)
+        lease = f"export:{state.guild_id}"
+        if not months or not await leases.acquire(lease, EXPORT_LEASE_TTL):
+            continue
+        try:
+            for month in months:
+                await export_month(state, month)
+        except OSError as e:
+            logging.error(f"Eksport miesiąca {month} (gildia {state.guild_id}) nie powiódł się: {e}")
+        finally:
+            await leases.release(lease)
+
+# ---------------------------------------------
+# TASK: compact_journal – snapshot w tle
+# ---------------------------------------------
+@tasks.loop(minutes=15)
+async def compact_journal():
+    metrics.task_tick("compact_journal", 15 * 60)
+    # Każdy proces kompaktuje tylko własny stan (przy sqlite to checkpoint WAL)
+    if storage.has_pending():
+        compact_data()
 
 # ---------------------------------------------
-# EVENT: on_ready
+# START: setup_hook (raz na proces) i on_ready
 # ---------------------------------------------
+@contextlib.contextmanager
+def startup_phase(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings[name] = time.perf_counter() - start
+        logging.info(f"Start: {name} – {startup_timings[name]:.3f}s")
+
+@bot.event
+async def setup_hook():
+    # Przed połączeniem z gatewayem: dane są w pamięci, zanim przyjdzie pierwsze zdarzenie.
+    with startup_phase("load_data"):
+        load_data()
+    nickname_queue.start()
+    global loop_lag_task
+    instrument_http()
+    loop_lag_task = asyncio.create_task(monitor_loop_lag())
+    await start_metrics_server()
+
+async def ensure_guild_messages(g: discord.Guild):
+    # Jeśli dedykowany kanał ustawiony, aktywujemy wiadomości na nim
+    state = guild_states.get(g.id)
+    if state is None or not state.settings["dedicated_channel_id"]:
+        return
+    channel = g.get_channel(state.settings["dedicated_channel_id"])
+    if not channel:
+        return
+    try:
+        await channel.fetch_message(state.settings["status_message_id"])
+    except (discord.NotFound, TypeError):
+        text = (
+            "**Kliknij w reakcję, aby dodać spożycie**:\n"
+            "🍺 — Piwo (3h)\n"
+            "🥃 — Whiskey (2h)\n"
+            "🍸 — Wódka (2h)\n"
+            "🍷 — Wino (2h)\n"
+            "🍹 — Drink (2h)\n"
+            "🍃 — Blunt (4h)\n"
+            "❌ — Wyczyść status"
+        )
+        msg = await channel.send(text)
+        set_setting(g.id, "status_message_id", msg.id)
+        for emoji in EMOJI_TO_TYPE:
+            await msg.add_reaction(emoji)
+        await msg.add_reaction(CLEAR_EMOJI)
+        save_data()
+    try:
+        await channel.fetch_message(state.settings["live_leaderboard_message_id"])
+    except (discord.NotFound, TypeError):
+        embed = build_leaderboard_embed(g)
+        msg = await channel.send(embed=embed)
+        state.live_leaderboard_digest = (channel.id, msg.id, embed_digest(embed))
+        set_setting(g.id, "live_leaderboard_message_id", msg.id)
+        set_setting(g.id, "live_leaderboard_channel_id", channel.id)
+        save_data()
+
+def strip_startup_suffixes(g: discord.Guild) -> int:
+    # Usuwamy NBSP i emotki z nicków (przez kolejkę, w jej tempie). Najpierw
+    # ci, których poprzedni shutdown nie zdążył przywrócić.
+    submitted = 0
+    state = guild_states.get(g.id)
+    pending = state.settings.get("pending_nick_restores") if state else None
+    if pending:
+        for member_id in pending:
+            member = g.get_member(member_id)
+            if member and member.nick and NBSP in member.nick:
+                nickname_queue.submit(member, restored_nick(member), source="startup")
+                submitted += 1
+        set_setting(g.id, "pending_nick_restores", None)
+        save_data()
+    for member in g.members:
+        if member.bot:
+            continue
+        if member.nick and NBSP in member.nick:
+            nickname_queue.submit(member, restored_nick(member), source="startup")
+            submitted += 1
+    return submitted
+
+async def reconcile_guild(g: discord.Guild, limit: asyncio.Semaphore):
+    async with limit:
+        try:
+            await ensure_guild_messages(g)
+        except discord.HTTPException as e:
+            logging.warning(f"Nie udało się przygotować wiadomości w gildii {g.name} ({g.id}): {e}")
+        strip_startup_suffixes(g)
+
+async def reconcile_guilds():
+    # Porządki po starcie w tle – bot obsługuje już komendy i reakcje.
+    with startup_phase("reconcile"):
+        limit = asyncio.Semaphore(STARTUP_RECONCILE_CONCURRENCY)
+        await asyncio.gather(*(reconcile_guild(g, limit) for g in bot.guilds))
+    with startup_phase("tree_sync"):
+        try:
+            await bot.tree.sync()
+            logging.info("Zarejestrowano slash commands.")
+        except Exception as e:
+            logging.warning(f"Nie udało się zsynchronizować slash commands: {e}")
+    logging.info(
+        "Start zakończony: " + ", ".join(f"{name} {seconds:.3f}s" for name, seconds in startup_timings.items())
+    )
+
 @bot.event
 async def on_ready():
+    global startup_done, reconcile_task
     logging.info(f"Zalogowano jako {bot.user}")
-    load_data()
-    # Jeśli dedykowany kanał ustawiony, aktywujemy wiadomości na nim
-    if dedicated_channel_id:
-        for g in bot.guilds:
-            channel = g.get_channel(dedicated_channel_id)
-            if channel:
-                global status_message_id
-                try:
-                    await channel.fetch_message(status_message_id)
-                except (discord.NotFound, TypeError):
-                    text = (
-                        "**Kliknij w reakcję, aby dodać spożycie**:\n"
-                        "🍺 — Piwo (3h)\n"
-                        "🥃 — Whiskey (2h)\n"
-                        "🍸 — Wódka (2h)\n"
-                        "🍷 — Wino (2h)\n"
-                        "🍹 — Drink (2h)\n"
-                        "🍃 — Blunt (4h)\n"
-                        "❌ — Wyczyść status"
-                    )
-                    msg = await channel.send(text)
-                    status_message_id = msg.id
-                    for emoji in EMOJI_TO_TYPE:
-                        await msg.add_reaction(emoji)
-                    await msg.add_reaction("❌")
-                    save_data()
-                global live_leaderboard_message_id, live_leaderboard_channel_id
-                try:
-                    await channel.fetch_message(live_leaderboard_message_id)
-                except (discord.NotFound, TypeError):
-                    embed = build_leaderboard_embed(g)
-                    msg = await channel.send(embed=embed)
-                    live_leaderboard_message_id = msg.id
-                    live_leaderboard_channel_id = channel.id
-                    save_data()
-                break
-    # Przy starcie – usuwamy NBSP i emotki z nicków
-    for g in bot.guilds:
-        for member in g.members:
-            if member.bot:
-                continue
-            if member.nick and NBSP in member.nick:
-                new_nick = remove_bot_suffix(member.nick)
-                if len(new_nick) > 32:
-                    new_nick = new_nick[:31] + "…"
-                try:
-                    await member.edit(nick=new_nick)
-                except (discord.Forbidden, discord.HTTPException):
-                    pass
+    # on_ready przychodzi też po wznowieniu połączenia – inicjalizację robimy raz.
+    if startup_done:
+        return
+    startup_done = True
+    startup_timings["to_ready"] = time.perf_counter() - PROCESS_START
+    with startup_phase("adopt_legacy"):
+        adopt_legacy_state()
+    with startup_phase("start_tasks"):
+        start_expiry_scheduler()
+        start_reaction_pipeline()
+        clean_statuses.start()
+        update_live_leaderboard.start()
+        export_monthly_stats.start()
+        compact_journal.start()
+    reconcile_task = asyncio.create_task(reconcile_guilds())
     await bot.change_presence(activity=discord.Game(name=f"Prefix: {BOT_PREFIX}"))
-    clean_statuses.start()
-    update_live_leaderboard.start()
-    export_monthly_stats.start()
-    try:
-        await bot.tree.sync()
-        logging.info("Zarejestrowano slash commands.")
-    except Exception as e:
-        logging.warning(f"Nie udało się zsynchronizować slash commands: {e}")
 
 # ---------------------------------------------
 # TASK: clean_statuses
 # ---------------------------------------------
 @tasks.loop(minutes=1)
+@timed("clean_statuses")
 async def clean_statuses():
-    now = datetime.datetime.now(timezone.utc)
-    for user_id, data in user_statuses.items():
-        for t in VALID_TYPES:
-            count = data[t]
-            exp_time = data["expires_per_substance"].get(t)
-            if count > 0 and exp_time and now > exp_time:
-                data[t] = 0
-                data["expires_per_substance"][t] = None
-                for guild_ in bot.guilds:
-                    m = guild_.get_member(user_id)
-                    if m and m.guild.owner_id == m.id:
-                        await update_nickname(m, source="expire")
-                        break
-        if all(data[sub] == 0 for sub in VALID_TYPES):
-            found_member = None
-            for guild_ in bot.guilds:
-                m = guild_.get_member(user_id)
-                if m:
-                    found_member = m
-                    break
-            if found_member:
-                current_nick = found_member.nick or found_member.name
-                pure_nick = remove_bot_suffix(current_nick)
-                data["original_nick"] = pure_nick
+    metrics.task_tick("clean_statuses", 60)
+    # Wygaśnięcia obsługuje planista (run_expiry_scheduler) dokładnie w terminie.
+    # Tu tylko siatka bezpieczeństwa (tani podgląd szczytu kopca) i zapis zmian.
+    await process_due_expiries()
+    prune_rate_buckets()
+    save_data()
+
+# ---------------------------------------------
+# LIMITY ZMIAN SPOŻYCIA (token bucket per użytkownik i per gildia)
+# ---------------------------------------------
+class TokenBucket:
+    __slots__ = ("burst", "rate", "tokens", "updated")
+
+    def __init__(self, burst: int, rate: float, now: float):
+        self.burst = burst
+        self.rate = rate
+        self.tokens = float(burst)
+        self.updated = now
+
+    def refill(self, now: float) -> float:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def wait_time(self) -> float:
+        return (1 - self.tokens) / self.rate
+
+def take_usage_token(guild_id: int, user_id: int, source: str) -> float:
+    # 0 – zmiana dozwolona (zużywa token użytkownika i gildii); inaczej liczba
+    # sekund do następnego tokenu. Token pobieramy tylko, gdy mają go oba kubełki,
+    # więc odrzucone próby jednego użytkownika nie uszczuplają limitu gildii.
+    state = get_guild_state(guild_id)
+    now = time.monotonic()
+    if state.rate_bucket is None:
+        state.rate_bucket = TokenBucket(GUILD_RATE_BURST, GUILD_RATE_PER_SECOND, now)
+    user_bucket = state.user_rate_buckets.get(user_id)
+    if user_bucket is None:
+        user_bucket = state.user_rate_buckets[user_id] = TokenBucket(USER_RATE_BURST, USER_RATE_PER_SECOND, now)
+    for scope, bucket in (("user", user_bucket), ("guild", state.rate_bucket)):
+        if bucket.refill(now) < 1:
+            metrics.inc("usage_rate_limited_total", scope=scope, source=source)
+            return bucket.wait_time()
+    user_bucket.tokens -= 1
+    state.rate_bucket.tokens -= 1
+    return 0.0
+
+def prune_rate_buckets():
+    # Pełny kubełek niczym się nie różni od nowego – usuwamy go, żeby słownik nie rósł
+    now = time.monotonic()
+    for state in guild_states.values():
+        full = [user_id for user_id, bucket in state.user_rate_buckets.items() if bucket.refill(now) >= bucket.burst]
+        for user_id in full:
+            del state.user_rate_buckets[user_id]
+
+metrics.gauge("usage_rate_buckets", lambda: sum(len(state.user_rate_buckets) for state in guild_states.values()))
+
+def rate_limit_message(wait: float) -> str:
+    return f"Zwolnij – kolejną zmianę możesz zrobić za {math.ceil(wait)} s."
+
+# ---------------------------------------------
+# EVENT: on_raw_reaction_add – spożycie z reakcji (potok paczek)
+# ---------------------------------------------
+@bot.event
+async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
+    # Tylko dane z payloadu – bez pobierania wiadomości. Zdarzenie trafia do
+    # kolejki, a stan zmienia dopiero run_reaction_pipeline (paczkami).
+    if shutting_down:
+        return
+    state = guild_states.get(payload.guild_id) if payload.guild_id else None
+    if state is None or payload.message_id != state.settings["status_message_id"]:
+        return
+    member = payload.member
+    if member is None or member.bot:
+        return
+    emoji = str(payload.emoji)
+    if emoji != CLEAR_EMOJI and emoji not in EMOJI_TO_TYPE:
+        return
+    # Ponad limit: odrzucamy bez żadnego wywołania API. Reakcja zostaje na
+    # wiadomości, więc tym samym emoji nie da się spamować, dopóki użytkownik
+    # sam jej nie zdejmie.
+    if take_usage_token(payload.guild_id, member.id, "reaction"):
+        return
+    reaction_queue.put_nowait((payload.channel_id, payload.message_id, member, emoji))
+
+async def apply_reaction_batch(batch: list):
+    touched = {}
+    pending = {}  # {(guild_id, user_id): (original_nick, {typ: ilość})} – scalone reakcje
+    merged = 0
+
+    def apply_pending(key):
+        entry = pending.pop(key, None)
+        if entry is not None:
+            original_nick, amounts = entry
+            for typ, amount in amounts.items():
+                add_usage(key[0], key[1], original_nick, typ, amount)
+
+    for channel_id, message_id, member, emoji in batch:
+        key = (member.guild.id, member.id)
+        if emoji == CLEAR_EMOJI:
+            # Wcześniejsze reakcje muszą trafić do statystyk miesiąca przed wyczyszczeniem
+            apply_pending(key)
+            if member.id in get_guild_state(key[0]).users:
+                clear_usage(*key)
+                touched[key] = member
+            continue
+        typ = EMOJI_TO_TYPE[emoji]
+        amounts = pending.setdefault(key, (remove_bot_suffix(member.nick or member.name), {}))[1]
+        if typ in amounts:
+            merged += 1
+        amounts[typ] = amounts.get(typ, 0) + 1
+        touched[key] = member
+    for key in list(pending):
+        apply_pending(key)
+    if merged:
+        metrics.inc("reactions_merged_total", merged)
+    # Jeden zapis na całą paczkę, jedno odświeżenie nicku na użytkownika.
     save_data()
+    for member in touched.values():
+        await update_nickname(member)
+
+async def acknowledge_reactions(batch: list):
+    for channel_id, message_id, member, emoji in batch:
+        channel = bot.get_channel(channel_id)
+        if channel is None:
+            continue
+        try:
+            await channel.get_partial_message(message_id).remove_reaction(emoji, member)
+        except discord.HTTPException:
+            pass
+
+async def run_reaction_pipeline():
+    # None w kolejce (drain_reaction_pipeline) kończy potok po zastosowaniu
+    # wszystkiego, co przyszło wcześniej.
+    stop = False
+    while not stop:
+        event = await reaction_queue.get()
+        if event is None:
+            return
+        batch = [event]
+        await asyncio.sleep(REACTION_BATCH_WINDOW)
+        while len(batch) < REACTION_BATCH_SIZE and not reaction_queue.empty():
+            event = reaction_queue.get_nowait()
+            if event is None:
+                stop = True
+                break
+            batch.append(event)
+        try:
+            await apply_reaction_batch(batch)
+        except Exception as e:
+            logging.error(f"Błąd przetwarzania paczki reakcji: {e}")
+        # Pętla trzyma zadania słabo – referencja chroni je przed GC w trakcie
+        task = asyncio.create_task(acknowledge_reactions(batch))
+        acknowledge_tasks.add(task)
+        task.add_done_callback(acknowledge_tasks.discard)
+
+def start_reaction_pipeline():
+    global reaction_task
+    if reaction_task is None or reaction_task.done():
+        reaction_task = asyncio.create_task(run_reaction_pipeline())
+
+async def drain_reaction_pipeline():
+    # Zamknięcie: reakcje z kolejki i paczka w trakcie mają już zużyte tokeny –
+    # stosujemy je, zanim zatrzymamy potok i zrobimy ostatni zapis. Potem
+    # czekamy na zdjęcie reakcji (te same ramy czasu), resztę anulujemy.
+    start_reaction_pipeline()
+    reaction_queue.put_nowait(None)
+    try:
+        await asyncio.wait_for(reaction_task, timeout=SHUTDOWN_DEADLINE)
+    except asyncio.TimeoutError:
+        logging.warning(f"Nie zdążono zastosować reakcji z kolejki w {SHUTDOWN_DEADLINE}s.")
+    if acknowledge_tasks:
+        _, pending = await asyncio.wait(set(acknowledge_tasks), timeout=SHUTDOWN_DEADLINE)
+        for task in pending:
+            task.cancel()
 
 # ---------------------------------------------
-# EVENT: on_message – filtr kanału
+# EVENT: on_message – filtr prefiksu, komendy i kanału
 # ---------------------------------------------
+def command_channels(state: GuildState) -> frozenset:
+    # Kanał nasłuchu + lista dozwolonych; pusty zbiór = wszystkie kanały.
+    # Wynik trzymamy w GuildState do następnej zmiany ustawień.
+    if state.command_channels is None:
+        channels = set(state.settings.get("allowed_channel_ids") or ())
+        if state.settings["listening_channel_id"] is not None:
+            channels.add(state.settings["listening_channel_id"])
+        state.command_channels = frozenset(channels)
+    return state.command_channels
+
 @bot.event
 async def on_message(message: discord.Message):
+    # Szybka ścieżka na surowej treści – Context (get_context + parsowanie)
+    # budujemy tylko dla znanej komendy w dozwolonym kanale.
     if message.author.bot:
         return
-    if listening_channel_id is not None and message.channel.id != listening_channel_id:
+    content = message.content
+    if not content.startswith(BOT_PREFIX):
+        metrics.inc("messages_total", result="no_prefix")
         return
+    name = content[len(BOT_PREFIX):].split(maxsplit=1)
+    if not name or name[0] not in bot.all_commands:
+        metrics.inc("messages_total", result="unknown_command")
+        return
+    state = guild_states.get(message.guild.id) if message.guild else None
+    if state is not None:
+        channels = command_channels(state)
+        if channels and message.channel.id not in channels:
+            metrics.inc("messages_total", result="channel")
+            return
+    metrics.inc("messages_total", result="dispatched")
     await bot.process_commands(message)
 
 # ---------------------------------------------
 # KOMENDY: help, add, status, clear, leaderboard, init_status_message, setchannel,
-#          live_leaderboard, setdedicatedchannel, shutdown, ping
+#          live_leaderboard, archiwum, setdedicatedchannel, allowchannel, stats, shutdown, ping
 # ---------------------------------------------
 def get_help_text() -> str:
     return (
@@ -529,11 +3059,14 @@ def get_help_text() -> str:
         f"{BOT_PREFIX}setchannel <kanał> – Ustawia kanał nasłuchu (admin)\n"
         f"{BOT_PREFIX}live_leaderboard – Tworzy i aktualizuje co minutę embed z wynikami (admin)\n"
         f"{BOT_PREFIX}setdedicatedchannel <kanał> – Ustawia dedykowany kanał (admin)\n"
+        f"{BOT_PREFIX}allowchannel <kanał> – Dodaje kanał do listy kanałów komend albo go z niej usuwa (admin)\n"
+        f"{BOT_PREFIX}stats – Metryki bota: czasy, wywołania API, opóźnienia (admin)\n"
         f"{BOT_PREFIX}shutdown – Bezpieczne wyłączenie bota (admin)\n\n"
         "**Slash commands**:\n"
         "/help – ta sama pomoc\n"
-        "/add, /status, /clear, /leaderboard, /init_status_message, /setchannel, /live_leaderboard, /setdedicatedchannel, /shutdown, /ping\n"
-        "(Działają analogicznie do komend prefiksowych.)"
+        "/add, /status, /clear, /leaderboard, /init_status_message, /setchannel, /live_leaderboard, /setdedicatedchannel, /allowchannel, /shutdown, /ping\n"
+        "(Działają analogicznie do komend prefiksowych.)\n"
+        "/archiwum [nick] [rok] – Ranking wszech czasów albo sumy użytkownika z zamkniętych miesięcy"
     )
 
 @bot.command(name="help")
@@ -544,11 +3077,133 @@ async def help_cmd(ctx: commands.Context):
 async def help_slash_cmd(interaction: discord.Interaction):
     await interaction.response.send_message(get_help_text())
 
+async def handle_add(author: discord.Member, target: discord.Member, typ: str, amount: int) -> str:
+    if shutting_down:
+        return "Bot jest w trakcie wyłączania – spróbuj po ponownym uruchomieniu."
+    typ = typ.lower()
+    if typ not in VALID_TYPES:
+        return f"Nieznany typ. Dostępne: {', '.join(sorted(VALID_TYPES))}."
+    if amount <= 0:
+        return "Ilość musi być dodatnia."
+    if target.id != author.id and not can_add_for_others(author):
+        return "Nie masz uprawnień, aby dodawać innym (Manage Nicknames / Admin)."
+    wait = take_usage_token(target.guild.id, author.id, "command")
+    if wait:
+        return rate_limit_message(wait)
+    original_nick = remove_bot_suffix(target.nick or target.name)
+    add_usage(target.guild.id, target.id, original_nick, typ, amount)
+    await update_nickname(target)
+    save_data()
+    return f"Dodano {TYPE_TO_EMOJI[typ]}{amount} dla {target.display_name}."
+
+async def handle_clear(author: discord.Member, target: discord.Member) -> str:
+    if shutting_down:
+        return "Bot jest w trakcie wyłączania – spróbuj po ponownym uruchomieniu."
+    if target.id != author.id and not can_clear_others(author):
+        return "Nie masz uprawnień, aby czyścić status innym (Manage Nicknames / Admin)."
+    if target.id not in get_guild_state(target.guild.id).users:
+        return f"{target.display_name} nie ma statusu."
+    wait = take_usage_token(target.guild.id, author.id, "command")
+    if wait:
+        return rate_limit_message(wait)
+    clear_usage(target.guild.id, target.id)
+    await update_nickname(target)
+    save_data()
+    return f"Wyczyszczono status {target.display_name}."
+
+@bot.command()
+@commands.guild_only()
+async def add(ctx: commands.Context, *args):
+    if len(args) == 2:
+        target, typ, amount = ctx.author, args[0], args[1]
+    elif len(args) == 3:
+        target = find_user_in_guild(ctx.guild, args[0])
+        typ, amount = args[1], args[2]
+        if target is None:
+            await ctx.send(f"Nie znaleziono użytkownika {args[0]}.")
+            return
+    else:
+        await ctx.send(f"Użycie: {BOT_PREFIX}add [<nick>] <typ> <ilość>")
+        return
+    if not amount.isdigit():
+        await ctx.send("Ilość musi być liczbą.")
+        return
+    await ctx.send(await handle_add(ctx.author, target, typ, int(amount)))
+
+@bot.tree.command(name="add", description="Dodaje spożycie do Twojego (lub cudzego) statusu")
+@app_commands.guild_only()
+@app_commands.describe(typ="Typ: piwo, wodka, whiskey, wino, drink, blunt", ilosc="Ilość", nick="Użytkownik (Manage Nicknames / Admin)")
+@app_commands.autocomplete(nick=member_autocomplete)
+async def add_slash(interaction: discord.Interaction, typ: str, ilosc: int = 1, nick: str = None):
+    target = interaction.user
+    if nick:
+        target = find_user_in_guild(interaction.guild, nick)
+        if target is None:
+            await interaction.response.send_message(f"Nie znaleziono użytkownika {nick}.", ephemeral=True)
+            return
+    await interaction.response.send_message(await handle_add(interaction.user, target, typ, ilosc))
+
+@bot.command()
+@commands.guild_only()
+async def clear(ctx: commands.Context, nick: str = None):
+    target = ctx.author
+    if nick:
+        target = find_user_in_guild(ctx.guild, nick)
+        if target is None:
+            await ctx.send(f"Nie znaleziono użytkownika {nick}.")
+            return
+    await ctx.send(await handle_clear(ctx.author, target))
+
+@bot.tree.command(name="clear", description="Czyści Twój (lub cudzy) status")
+@app_commands.guild_only()
+@app_commands.describe(nick="Użytkownik (Manage Nicknames / Admin)")
+@app_commands.autocomplete(nick=member_autocomplete)
+async def clear_slash(interaction: discord.Interaction, nick: str = None):
+    target = interaction.user
+    if nick:
+        target = find_user_in_guild(interaction.guild, nick)
+        if target is None:
+            await interaction.response.send_message(f"Nie znaleziono użytkownika {nick}.", ephemeral=True)
+            return
+    await interaction.response.send_message(await handle_clear(interaction.user, target))
+
+@bot.command()
+@commands.guild_only()
+async def leaderboard(ctx: commands.Context, mode: str = None):
+    if mode == "hide":
+        view = LeaderboardView(ctx.guild, text=True)
+        try:
+            await ctx.author.send(**view.render(), view=view)
+        except discord.Forbidden:
+            await ctx.send("Nie mogę wysłać Ci wiadomości prywatnej.")
+        return
+    view = LeaderboardView(ctx.guild)
+    await ctx.send(**view.render(), view=view)
+
+@bot.tree.command(name="leaderboard", description="Tabela wyników bieżącego miesiąca (ze stronami)")
+@app_commands.guild_only()
+@app_commands.describe(ukryj="Pokaż tylko Tobie")
+async def leaderboard_slash(interaction: discord.Interaction, ukryj: bool = False):
+    view = LeaderboardView(interaction.guild)
+    await interaction.response.send_message(**view.render(), view=view, ephemeral=ukryj)
+
+@bot.tree.command(name="archiwum", description="Ranking wszech czasów lub sumy użytkownika z zamkniętych miesięcy")
+@app_commands.guild_only()
+@app_commands.describe(nick="Użytkownik (bez – ranking)", rok="Rok, np. 2025 (bez – cała historia)")
+@app_commands.autocomplete(nick=member_autocomplete)
+async def archive_slash(interaction: discord.Interaction, nick: str = None, rok: int = None):
+    target = None
+    if nick:
+        target = find_user_in_guild(interaction.guild, nick)
+        if target is None:
+            await interaction.response.send_message(f"Nie znaleziono użytkownika {nick}.", ephemeral=True)
+            return
+    await interaction.response.send_message(build_archive_text(interaction.guild, target, rok))
+
 @bot.command()
 @commands.has_permissions(administrator=True)
 async def setdedicatedchannel(ctx: commands.Context, channel: discord.TextChannel):
-    global dedicated_channel_id
-    dedicated_channel_id = channel.id
+    set_setting(ctx.guild.id, "dedicated_channel_id", channel.id)
     save_data()
     await ctx.send(f"Dedykowany kanał ustawiony na {channel.mention}.")
 
@@ -556,38 +3211,121 @@ async def setdedicatedchannel(ctx: commands.Context, channel: discord.TextChanne
 @app_commands.checks.has_permissions(administrator=True)
 @app_commands.describe(channel="Dedykowany kanał dla wiadomości z reakcjami i leaderboardu")
 async def setdedicatedchannel_slash(interaction: discord.Interaction, channel: discord.TextChannel):
-    global dedicated_channel_id
-    dedicated_channel_id = channel.id
+    set_setting(interaction.guild.id, "dedicated_channel_id", channel.id)
     save_data()
     await interaction.response.send_message(f"Dedykowany kanał ustawiony na {channel.mention}.", ephemeral=False)
 
+def toggle_allowed_channel(guild_id: int, channel: discord.TextChannel) -> str:
+    allowed = list(get_guild_state(guild_id).settings.get("allowed_channel_ids") or ())
+    if channel.id in allowed:
+        allowed.remove(channel.id)
+        reply = f"Usunięto {channel.mention} z listy kanałów komend."
+    else:
+        allowed.append(channel.id)
+        reply = f"Dodano {channel.mention} do listy kanałów komend."
+    set_setting(guild_id, "allowed_channel_ids", allowed or None)
+    save_data()
+    if not allowed:
+        reply += " Lista jest pusta – komendy działają w każdym kanale."
+    return reply
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def allowchannel(ctx: commands.Context, channel: discord.TextChannel):
+    await ctx.send(toggle_allowed_channel(ctx.guild.id, channel))
+
+@bot.tree.command(name="allowchannel", description="Dodaje kanał do listy kanałów komend albo go z niej usuwa (admin).")
+@app_commands.checks.has_permissions(administrator=True)
+@app_commands.describe(channel="Kanał, w którym mają działać komendy prefiksowe")
+async def allowchannel_slash(interaction: discord.Interaction, channel: discord.TextChannel):
+    await interaction.response.send_message(toggle_allowed_channel(interaction.guild.id, channel))
+
+def restored_nick(member: discord.Member) -> str:
+    original = remove_bot_suffix(member.nick)
+    if len(original) > 32:
+        original = original[:31] + "…"
+    return original
+
+def shutdown_nick(member: discord.Member) -> str:
+    # Cel edycji przy zamknięciu: nick bez sufiksu; bez sufiksu – bez zmian
+    if member.nick and NBSP in member.nick:
+        return restored_nick(member)
+    return member.nick or member.name
+
+async def graceful_shutdown() -> str:
+    # Wspólna ścieżka .shutdown i /shutdown. Najpierw zatrzymujemy wszystko, co
+    # mogłoby zlecić nowe edycje, potem przywracamy nicki z sufiksem bota (kolejka:
+    # NICK_QUEUE_WORKERS gildii naraz, tempo i 429 per gildia) do SHUTDOWN_DEADLINE.
+    # Czego nie zdążymy – zapisujemy w pending_nick_restores na następny start.
+    global shutting_down
+    shutting_down = True
+    await drain_reaction_pipeline()
+    for task in (expiry_task, reconcile_task, leaderboard_refresh_task):
+        if task:
+            task.cancel()
+    clean_statuses.cancel()
+    update_live_leaderboard.cancel()
+    export_monthly_stats.cancel()
+    compact_journal.cancel()
+    requested = 0
+    nickname_queue.start()
+    # Kolejka obsługuje gildie po kolei, więc wszystkie ruszają od razu.
+    for g in bot.guilds:
+        for member in g.members:
+            if not member.bot and member.nick and NBSP in member.nick:
+                nickname_queue.submit(member, restored_nick(member), source="shutdown")
+                requested += 1
+    # Edycje zlecone przed zamknięciem (np. pierwszy sufiks) też kończą się
+    # nickiem bez sufiksu – te bez zmiany kolejka pominie.
+    nickname_queue.retarget(shutdown_nick, "shutdown")
+    try:
+        await asyncio.wait_for(nickname_queue.join(), timeout=SHUTDOWN_DEADLINE)
+    except asyncio.TimeoutError:
+        logging.warning(f"Nie zdążono przywrócić wszystkich nicków w {SHUTDOWN_DEADLINE}s.")
+    nickname_queue.stop()
+    leftover = {}
+    for guild_id, member_id in nickname_queue.pending:
+        leftover.setdefault(guild_id, []).append(member_id)
+    nickname_queue.pending.clear()
+    for g in bot.guilds:
+        state = guild_states.get(g.id)
+        if state is not None and state.settings.get("pending_nick_restores") != leftover.get(g.id):
+            set_setting(g.id, "pending_nick_restores", leftover.get(g.id))
+    compact_data()
+    await persistence.flush()
+    # Zamknięcie bazy i dzierżaw też w wątku zapisu – po ostatniej paczce
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(persistence.executor, storage.close)
+    await loop.run_in_executor(persistence.executor, leases.close)
+    persistence.executor.shutdown(wait=True)
+    usage_archive.close()
+    if event_log is not None:
+        event_log.close()
+    if loop_lag_task:
+        loop_lag_task.cancel()
+    if metrics_runner:
+        await metrics_runner.cleanup()
+    left = sum(len(ids) for ids in leftover.values())
+    logging.info(f"Zamknięcie: przywrócono {requested - left}/{requested} nicków, odłożono {left}.")
+    summary = f"Dane zapisane, zadania zatrzymane. Przywrócono nicki: {requested - left}/{requested}."
+    if left:
+        summary += f" Pozostałe ({left}) zostaną przywrócone przy następnym starcie."
+    return summary + " Wyłączam bota."
+
 @bot.command()
 @commands.has_permissions(administrator=True)
 async def shutdown(ctx: commands.Context):
     """
     Bezpieczne wyłączenie bota:
-      - Przywraca oryginalne nicki (usuwa emotki).
+      - Przywraca oryginalne nicki tam, gdzie bot dodał sufiks.
       - Zapisuje dane.
       - Anuluje działające zadania.
       - Wyłącza bota.
     """
+    if shutting_down:
+        return
     await ctx.send("Bot jest w trakcie bezpiecznego wyłączania...")
-    for g in bot.guilds:
-        for member in g.members:
-            if member.bot:
-                continue
-            try:
-                original = remove_bot_suffix(member.nick) if member.nick else member.name
-                if len(original) > 32:
-                    original = original[:31] + "…"
-                await member.edit(nick=original)
-            except Exception as e:
-                logging.warning(f"Nie udało się przywrócić nicku dla {member.name}: {e}")
-    save_data()
-    clean_statuses.cancel()
-    update_live_leaderboard.cancel()
-    export_monthly_stats.cancel()
-    await ctx.send("Dane zapisane, zadania zatrzymane. Wyłączam bota.")
+    await ctx.send(await graceful_shutdown())
     await bot.close()
 
 @bot.tree.command(name="shutdown", description="Bezpiecznie wyłącza bota (admin).")
@@ -596,24 +3334,19 @@ async def shutdown_slash(interaction: discord.Interaction):
     if not interaction.guild:
         await interaction.response.send_message("Ta komenda działa tylko na serwerze.", ephemeral=True)
         return
-    for g in bot.guilds:
-        for member in g.members:
-            if member.bot:
-                continue
-            try:
-                original = remove_bot_suffix(member.nick) if member.nick else member.name
-                if len(original) > 32:
-                    original = original[:31] + "…"
-                await member.edit(nick=original)
-            except Exception as e:
-                logging.warning(f"Nie udało się przywrócić nicku dla {member.name}: {e}")
-    save_data()
-    clean_statuses.cancel()
-    update_live_leaderboard.cancel()
-    export_monthly_stats.cancel()
-    await interaction.response.send_message("Dane zapisane, zadania zatrzymane. Wyłączam bota.", ephemeral=True)
+    if shutting_down:
+        await interaction.response.send_message("Bot jest już w trakcie wyłączania.", ephemeral=True)
+        return
+    # Przywracanie nicków trwa dłużej niż 3 s na odpowiedź – najpierw defer
+    await interaction.response.defer(ephemeral=True)
+    await interaction.followup.send(await graceful_shutdown(), ephemeral=True)
     await bot.close()
 
+@bot.command(name="stats")
+@commands.has_permissions(administrator=True)
+async def stats_cmd(ctx: commands.Context):
+    await ctx.send(build_stats_text())
+
 @bot.tree.command(name="ping", description="Test – odpowiada 'Pong!'")
 async def ping_slash(interaction: discord.Interaction):
     await interaction.response.send_message("Pong!")